@@ -1,7 +1,7 @@
 import Sofa
-import SofaCaribou
-import SofaRuntime
-import Sofa.Gui
+import Sofa.Core
+import argparse
+import json
 import os, sys
 
 dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'src')
@@ -9,8 +9,10 @@ sys.path.append(os.path.abspath(dir))
 
 
 # Source code importation
-from vessel import VGraph
 from BaseDigitalTwin import BaseDigitalTwin
+from profiler import StageProfiler
+from headless import HeadlessRunner
+from sweep import set_parameters
 
 # Solvers, parenchyma, vessels and mapping parameters included in the digitaltwin dictionnary
 from parameters import digitaltwin
@@ -22,58 +24,87 @@ class ControlFrame(Sofa.Core.Controller, BaseDigitalTwin):
         self.root = self.CreateGraph(node)
 
     def CreateGraph(self, node): 
-        
-        node = self.required(node)
-
-        # Solver
-        node = self.addSolver(node, digitaltwin['solver'])
-
-        # Add parenchyma 
-        node = self.addParenchyma(node, digitaltwin['parenchyma'])
-        
-        # Add vessels
-        node = self.addVessels(node, digitaltwin['vessels'])
-
-        # Structuring centerlines into a list of polylines 
-        points = self.getSkeletonData(digitaltwin['vessels']['skeleton_output'])
-
-        # Creating the Graph data structure 
-        vessel = VGraph(points,digitaltwin['vessels']['sampling_rate'])
-        graph = vessel.graph
-
-        # Display the Vessels graph data structure
-        print("\n")
-        print("==============          The Graph          =================")
-        print(graph)
-        print("===========          End of the Graph          =============")
-        print("\n")
-
-        # Sofa graph node
-        vaisseau = node.getChild("vessels")
-        graph_node = vaisseau.addChild('Graphe_node')
-        
-        # Modeling vessels with beams
-        graph_node = self.VesselMechanicalModeling(graph_node, vessel, digitaltwin['vessels'], bc=False)
-        
-        # Display somme infos about the Vessels Graph
-        print('Total number of branch ', len(graph))
-        print("The sampling rate is: ", digitaltwin['vessels']['sampling_rate'])
-
-        # Coupling Beams 
-        graph_node = self.VesselMechanicalCoupling(graph_node, vessel, digitaltwin['vessels'])
-
-        # Mapping between the Parenchyma and Vessels: BeamRigid <-> BeamVec <-> Parenchyma
-        node = self.LiverToVesselMapping(node, vessel, digitaltwin['parenchyma'], digitaltwin['vessels'], digitaltwin['mapping'])
+
+        # Timing and memory of each stage of the scene building, see StageProfiler
+        self.profiler = StageProfiler(digitaltwin['profiling']['memory']) if digitaltwin['profiling']['enabled'] else None
+        root = node
+
+        with self.stage("CreateGraph", root): 
+            with self.stage("required", root): 
+                node = self.required(node)
+
+            # Solver
+            with self.stage("solver", root): 
+                node = self.addSolver(node, digitaltwin['solver'])
+
+            # Add parenchyma 
+            with self.stage("parenchyma", root): 
+                node = self.addParenchyma(node, digitaltwin['parenchyma'])
+            
+            # Add vessels
+            with self.stage("vessels", root): 
+                node = self.addVessels(node, digitaltwin['vessels'])
+
+            # Vessel graph data structure, loaded from the precompiled bundle when it is up to date
+            with self.stage("vessel model"): 
+                vessel = self.getVesselModel(digitaltwin['vessels'])
+            graph = vessel.graph
+
+            # Display the Vessels graph data structure
+            print("\n")
+            print("==============          The Graph          =================")
+            print(graph)
+            print("===========          End of the Graph          =============")
+            print("\n")
+
+            # Sofa graph node
+            vaisseau = node.getChild("vessels")
+            graph_node = vaisseau.addChild('Graphe_node')
+            
+            with self.stage("vessels modeling", root): 
+                if digitaltwin['vessels']['model'] == 'monolithic': 
+                    # Modeling the whole vessel tree as one beam, bifurcations are shared nodes
+                    graph_node = self.VesselMonolithicModeling(graph_node, vessel, digitaltwin['vessels'], bc=False)
+                else: 
+                    # Modeling vessels with beams
+                    graph_node = self.VesselMechanicalModeling(graph_node, vessel, digitaltwin['vessels'], bc=False)
+            
+            # Display somme infos about the Vessels Graph
+            print('Total number of branch ', len(graph))
+            print("The sampling rate is: ", digitaltwin['vessels']['sampling_rate'])
+
+            # Coupling Beams 
+            if digitaltwin['vessels']['model'] != 'monolithic': 
+                with self.stage("vessels coupling", root): 
+                    graph_node = self.VesselMechanicalCoupling(graph_node, vessel, digitaltwin['vessels'])
+
+            # Mapping between the Parenchyma and Vessels: BeamRigid <-> BeamVec <-> Parenchyma
+            with self.stage("liver to vessel mapping", root): 
+                node = self.LiverToVesselMapping(node, vessel, digitaltwin['parenchyma'], digitaltwin['vessels'], digitaltwin['mapping'])
+
+        # Report of the scene building
+        self.saveProfiling(digitaltwin['profiling'])
             
 
 def createScene(node): 
+    # Python bindings of the Caribou components, only needed to build the scene
+    import SofaCaribou
+
     node.addObject(ControlFrame(node))
 
 
+# Plugins imported before the scene is built
+PLUGINS = ["SofaOpenglVisual", "SofaImplicitOdeSolver", "SofaLoader"]
+
+
 def main(): 
-    SofaRuntime.importPlugin("SofaOpenglVisual")
-    SofaRuntime.importPlugin("SofaImplicitOdeSolver")
-    SofaRuntime.importPlugin("SofaLoader")
+    # Runtime and GUI are only needed when the scene is launched from this script
+    import SofaRuntime
+    import Sofa.Gui
+    import Sofa.Simulation
+
+    for plugin in PLUGINS: 
+        SofaRuntime.importPlugin(plugin)
 
     root = Sofa.Core.Node("root")
     createScene(root)
@@ -83,16 +114,52 @@ def main():
     Sofa.Gui.GUIManager.createGUI(root, __file__)
     Sofa.Gui.GUIManager.SetDimension(1080, 1080)
     Sofa.Gui.GUIManager.MainLoop(root)
-    Sofa.Gui.GUIManager.closeGUI(root, __file__)
-    Sofa.Gui.GUIManager.MainLoop(root)
     Sofa.Gui.GUIManager.closeGUI()
 
 
+def headless(steps, report=None): 
+    """
+        Simulates the scene without GUI, prints the throughput and returns the report, see HeadlessRunner
+
+        :steps : number of time steps
+        :report : json file of the per step metrics
+    """
+    runner = HeadlessRunner(createScene, PLUGINS)
+    runner.run(steps)
+    if report: 
+        runner.save(report)
+        print("Simulation report written in ", report)
+    print(runner.summary())
+    return runner.report
+
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Liver digital twin")
+    parser.add_argument('--headless', action='store_true', help="simulates without GUI")
+    parser.add_argument('--steps', type=int, default=100, help="number of time steps of a headless run")
+    parser.add_argument('--report', default="./data/profiling/simulation.json", help="json report of a headless run")
+    parser.add_argument('--parameters', default=None, help="json file of {dotted parameter name: value} overriding parameters.py")
+    parser.add_argument('--no-centerlines', action='store_true', help="uses the skeleton already in skeleton_output")
+    parser.add_argument('--trace-memory', action='store_true', help="traces the memory of the scene building in a headless run, it slows the build down")
+    arguments = parser.parse_args()
+
+    # Memory tracing would inflate the build time of a headless run, it is only on when requested here or in the parameters file
+    if arguments.headless: 
+        digitaltwin['profiling']['memory'] = arguments.trace_memory
+
+    # Parameters of a variant, e.g. from a parameter sweep
+    if arguments.parameters: 
+        with open(arguments.parameters) as file: 
+            set_parameters(digitaltwin, json.load(file))
+
     # Storing the centeralines in the given text file 
-    baseDT = BaseDigitalTwin()
-    baseDT.get_centerlines(digitaltwin['vessels']['meshFile'], digitaltwin['vessels']['skeleton_output'])
+    if not arguments.no_centerlines: 
+        baseDT = BaseDigitalTwin()
+        baseDT.get_centerlines(digitaltwin['vessels']['meshFile'], digitaltwin['vessels']['skeleton_output'])
 
     # Mechanical modeling and coupling of the vessels
-    main()
\ No newline at end of file
+    if arguments.headless: 
+        headless(arguments.steps, arguments.report)
+    else: 
+        main()
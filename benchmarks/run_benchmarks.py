@@ -0,0 +1,236 @@
+"""
+Preprocessing benchmarks on synthetic vessel trees, Sofa is never imported
+
+    python3 benchmarks/run_benchmarks.py                                  # 10 to 10^4 branches, results in benchmarks/results.json
+    python3 benchmarks/run_benchmarks.py --sizes 10 100 --save-baseline   # stores the results as the baseline
+    python3 benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --threshold 1.25
+
+The exit code is 1 when a stage is slower than the baseline by more than the threshold, 
+or when importing the preprocessing core loads Sofa
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir, 'src')
+sys.path.append(os.path.abspath(dir))
+
+from BaseDigitalTwin import BaseDigitalTwin
+from beam import Beam
+from bezier import Bezier, BezierBatch
+from vessel import ADJACENCY_TOLERANCE, VGraph
+from synthetic_tree import synthetic_tree, write_skeleton
+
+
+# Benchmarked stages, in pipeline order
+STAGES = ['getSkeletonData', 'VGraph', 'Beam.get_sample', 'Bezier fitting', 'frames', 'MO and topology', 'getVesselModel']
+
+# Modules whose cold start import is timed, BaseDigitalTwin imports all the preprocessing core
+IMPORTS = ['BaseDigitalTwin']
+
+
+def timed(function, repeat, setup=None): 
+    """
+    Runs a function several times, returns its result and its best wall time
+
+    :setup : function run before each run, out of the timing, its result is passed to the function
+    """
+    best = None
+    for _ in range(repeat): 
+        arguments = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        result = function(*arguments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run_size(number_of_branches, settings, repeat): 
+    """
+    Times every stage of the preprocessing on a synthetic tree
+
+    Returns {stage: best wall time in seconds}
+    """
+    branches = synthetic_tree(number_of_branches, settings['depth'], settings['points_per_branch'],
+                              settings['spacing'], settings['noise'], settings['seed'])
+    sampling_rate = settings['sampling_rate']
+    times = {}
+
+    with tempfile.TemporaryDirectory() as directory: 
+        filename = os.path.join(directory, "skeleton.txt")
+        write_skeleton(branches, filename)
+
+        # Reading the centerlines
+        vaisseau, times['getSkeletonData'] = timed(lambda: BaseDigitalTwin().getSkeletonData(filename), repeat)
+
+        # Streamed reading, graph, sampling and fitting of all the beams as the scene does it, without bundle
+        vessels = {
+            'skeleton_output': filename, 
+            'bundle': None, 
+            'sampling_rate': sampling_rate, 
+            'sampling_mode': 'arclength', 
+            'adjacency_tolerance': settings['tolerance'], 
+            'frame_mode': 'rmf', 
+            'workers': settings['workers'], 
+            'executor': 'process', 
+        }
+        _, times['getVesselModel'] = timed(lambda: BaseDigitalTwin().getVesselModel(vessels), repeat)
+
+    # Graph of the branches
+    vessel, times['VGraph'] = timed(lambda: VGraph(vaisseau, sampling_rate, tolerance=settings['tolerance']), repeat)
+
+    # Sampling of each branch
+    beams, times['Beam.get_sample'] = timed(lambda: [Beam(branch, sampling_rate) for branch in vaisseau], repeat)
+    samples = [beam.sample for beam in beams]
+
+    # Bezier control points of each branch
+    _, times['Bezier fitting'] = timed(lambda: [Bezier(sample).get_control_points() for sample in samples], repeat)
+
+    # Tangentes, normals and binormals of all the branches at once, as VGraph.get_frames
+    def frames(): 
+        points, offsets = vessel.get_ragged(samples)
+        return BezierBatch(points, offsets).get_frames()
+    (tangentes, normals, binormals), times['frames'] = timed(frames, repeat)
+
+    # MechanicalObjects and topologies of all the beams
+    def mechanical_objects(): 
+        return [(beam.get_MO_rigid((tangentes[i], normals[i], binormals[i])), beam.get_MO_vec(), beam.get_topology())
+                for i, beam in enumerate(beams)]
+    _, times['MO and topology'] = timed(mechanical_objects, repeat)
+
+    return times
+
+
+def time_import(module, repeat): 
+    """
+    Times the import of a module in a new interpreter, so nothing is already imported
+
+    Returns the best wall time and the list of the Sofa modules the import loaded
+    """
+    code = "import sys, time; sys.path.append({!r}); start = time.perf_counter(); import {}; " \
+           "print(time.perf_counter() - start); print(' '.join(name for name in sys.modules if name.startswith('Sofa')))".format(os.path.abspath(dir), module)
+    best = None
+    for _ in range(repeat): 
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split("\n")
+        elapsed = float(output[0])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output[1].split()
+
+
+def compare(results, baseline, threshold, min_time): 
+    """
+    Compares results with a baseline, a stage regresses when it is slower than the baseline
+    by more than the threshold ratio and by more than min_time seconds
+
+    Returns the list of the regressions as (size, stage, baseline time, time)
+    """
+    # Import times are compared as a size of their own
+    tables = dict(results['sizes'], imports=results.get('imports', {}))
+    references = dict(baseline.get('sizes', {}), imports=baseline.get('imports', {}))
+
+    regressions = []
+    for size, times in tables.items(): 
+        for stage, elapsed in times.items(): 
+            reference = references.get(size, {}).get(stage)
+            if reference is None: 
+                continue
+            ratio = elapsed / reference if reference > 0 else float('inf')
+            status = "ok"
+            if ratio > threshold and elapsed - reference > min_time: 
+                status = "REGRESSION"
+                regressions.append((size, stage, reference, elapsed))
+            print("{:>7} {:<16} {:10.4f} s {:10.4f} s {:6.2f}x {}".format(size, stage, reference, elapsed, ratio, status))
+    return regressions
+
+
+def main(argv=None): 
+    here = os.path.abspath(os.path.dirname(__file__))
+
+    parser = argparse.ArgumentParser(description="Preprocessing benchmarks on synthetic vessel trees")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help="numbers of branches")
+    parser.add_argument('--depth', type=int, default=None, help="maximal depth of the trees")
+    parser.add_argument('--points-per-branch', type=int, default=50)
+    parser.add_argument('--spacing', type=float, default=0.001, help="distance between two points of a branch")
+    parser.add_argument('--noise', type=float, default=0.0001, help="standard deviation of the point noise")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sampling-rate', type=float, default=0.005)
+    parser.add_argument('--workers', type=int, default=1, help="preprocessing workers of the getVesselModel stage")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage, the best time is kept")
+    parser.add_argument('--output', default=os.path.join(here, "results.json"))
+    parser.add_argument('--baseline', default=os.path.join(here, "baseline.json"))
+    parser.add_argument('--save-baseline', action='store_true', help="stores the results as the baseline")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument('--min-time', type=float, default=0.001, help="slowdown in seconds below which nothing regresses")
+    arguments = parser.parse_args(argv)
+
+    settings = {
+        'depth': arguments.depth,
+        'points_per_branch': arguments.points_per_branch,
+        'spacing': arguments.spacing,
+        'noise': arguments.noise,
+        'seed': arguments.seed,
+        'sampling_rate': arguments.sampling_rate,
+        'tolerance': ADJACENCY_TOLERANCE,
+        'workers': arguments.workers,
+    }
+    results = {
+        'settings': settings,
+        'repeat': arguments.repeat,
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                    'python': platform.python_version(), 'numpy': np.__version__},
+        'imports': {},
+        'sizes': {},
+    }
+
+    # Cold start imports, the preprocessing core must not load Sofa
+    sofa_modules = []
+    for module in IMPORTS: 
+        results['imports'][module], loaded = time_import(module, arguments.repeat)
+        print("import {}: {:.4f} s".format(module, results['imports'][module]))
+        if len(loaded): 
+            print("Error: importing ", module, " loaded Sofa: ", " ".join(loaded))
+            sofa_modules.extend(loaded)
+
+    for size in arguments.sizes: 
+        times = run_size(size, settings, arguments.repeat)
+        results['sizes'][str(size)] = times
+        print("{:>7} branches: ".format(size) + ", ".join("{} {:.4f} s".format(stage, times[stage]) for stage in STAGES))
+
+    with open(arguments.output, 'w') as file: 
+        json.dump(results, file, indent=4)
+    print("Results written in ", arguments.output)
+    if len(sofa_modules): 
+        return 1
+
+    if arguments.save_baseline: 
+        with open(arguments.baseline, 'w') as file: 
+            json.dump(results, file, indent=4)
+        print("Baseline written in ", arguments.baseline)
+        return 0
+
+    if not os.path.exists(arguments.baseline): 
+        print("No baseline in ", arguments.baseline, ", run with --save-baseline to store one")
+        return 0
+
+    with open(arguments.baseline) as file: 
+        baseline = json.load(file)
+    if baseline.get('settings') != settings: 
+        print("Warning: the baseline was run with other settings ", baseline.get('settings'))
+
+    regressions = compare(results, baseline, arguments.threshold, arguments.min_time)
+    if len(regressions): 
+        print(len(regressions), " stages regressed by more than ", arguments.threshold, "x")
+        return 1
+    print("No regression")
+    return 0
+
+
+if __name__ == '__main__': 
+    sys.exit(main())
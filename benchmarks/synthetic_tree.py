@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def synthetic_tree(number_of_branches, depth=None, points_per_branch=50, spacing=0.001, noise=0.0001, seed=0): 
+    """
+    Generates a synthetic vessel tree: every branch starts at the end of a parent branch,
+    so branches meet at bifurcations exactly as the centerlines of a vessel mesh
+
+    :number_of_branches : number of branches of the tree
+    :depth : maximal depth of a branch in the tree, unbounded by default
+    :points_per_branch : number of points of each branch
+    :spacing : distance between two consecutive points of a branch
+    :noise : standard deviation of the gaussian noise added to the points
+    :seed : seed of the random generator, the same seed gives the same tree
+
+    Returns the list of the (points_per_branch, 3) arrays of the branches
+    """
+    rng = np.random.default_rng(seed)
+
+    branches = []
+    depths = []
+
+    # Branches that are not at the maximal depth, they can get children
+    parents = []
+    for i in range(number_of_branches): 
+
+        # Parent branch: any branch that can get children, the root otherwise
+        if len(parents): 
+            parent = parents[rng.integers(len(parents))]
+            start = branches[parent][-1]
+            depths.append(depths[parent] + 1)
+        else: 
+            start = np.zeros(3)
+            depths.append(0)
+        if depth is None or depths[i] < depth: 
+            parents.append(i)
+
+        # Random direction, straight steps then noise, the start point is kept on the parent end
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        steps = direction * spacing + rng.normal(0, noise, (points_per_branch - 1, 3))
+        branches.append(np.vstack([start, start + np.cumsum(steps, axis=0)]))
+
+    return branches
+
+
+def write_skeleton(branches, filename): 
+    """
+    Writes branches in the text skeleton format: one "x y z" line per point,
+    branches separated by a blank line
+    """
+    with open(filename, 'w') as file: 
+        for branch in branches: 
+            np.savetxt(file, branch, fmt="%.17g")
+            file.write("\n")
@@ -1,3 +1,6 @@
+# Default adjacency tolerance of VGraph, the src folder is in the path of every script importing the parameters
+from vessel import ADJACENCY_TOLERANCE
+
 # Solver parameter
 solver = {
     'newton_iterations': '100',
@@ -31,6 +34,7 @@ RestShape = {
 vessels = {
     'meshFile': "./data/mesh/processed_porteveine.stl",
     'skeleton_output': "./data/skeleton/output_skeleton.txt",
+    'bundle': "./data/skeleton/cache/vessels_bundle.npz",
     'young_modulus': '0.62e5',
     'poissonRatio': '0.4',
     'radiusInner': '0.0029',
@@ -39,12 +43,29 @@ vessels = {
     'showAxisSizeFactor': '0.005',
     'visualColor': 'red',
     'sampling_rate': 0.005,
+    'sampling_mode': 'arclength',
+    'adjacency_tolerance': ADJACENCY_TOLERANCE,
+    'frame_mode': 'rmf',
+    'adaptive_sampling': {'min_spacing': 0.0025, 'max_spacing': 0.02, 'tolerance': 0.0005, 'bifurcation_distance': 0.005},
+    'model': 'per_branch',
+    'beam_class': 'Beam',
+    'workers': 1,
+    'executor': 'process',
     'vesselsCoupling': RestShape,
 }
 
 # Mapping parameters
 mapping = {
-    'stiffness': " 1000 0 0 "
+    'stiffness': " 1000 0 0 ",
+    'mode': 'per_branch',
+}
+
+# Scene building profiling
+profiling = {
+    'enabled': True,
+    'memory': False,
+    'report': "./data/profiling/scene_build.json",
+    'summary': True,
 }
 
 # Digital Twin parameters
@@ -52,5 +73,6 @@ digitaltwin = {
     'solver': solver,
     'parenchyma': parenchyma,
     'vessels': vessels,
-    'mapping': mapping    
+    'mapping': mapping,
+    'profiling': profiling
 }
\ No newline at end of file
@@ -1,7 +1,17 @@
-from platform import node
-import Sofa.Core
+import numpy as np
+import os
+from contextlib import nullcontext
+
+from skeleton import iter_skeleton, read_binary_skeleton, read_text_skeleton, split_branches
+from skeleton_cache import SkeletonCache
+from vessel import VGraph, get_misalignment
+from beam import BEAM_CLASSES
+from bundle import VesselBundle
+
+
+# Angle in degrees between a tree element and the x axis of its nodes above which the monolithic model warns
+MISALIGNMENT_WARNING = 20
 
-from beam import Beam
 
 class BaseDigitalTwin: 
     """
@@ -9,6 +19,37 @@ class BaseDigitalTwin:
     """
     def __init__(self) -> None:
         pass
+
+    def stage(self, name, node=None): 
+        """
+            Stage of the scene building, timed by self.profiler when there is one: 
+
+                with self.stage("solver", root): 
+                    ...
+
+            :name : name of the stage
+            :node : Sofa node whose created nodes and components are counted
+        """
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None: 
+            return nullcontext()
+        return profiler.stage(name, node)
+
+    def saveProfiling(self, profiling_parameters): 
+        """
+            Writes the json report of the profiled stages and prints their flame style summary
+
+            :profiling_parameters : profiling dictionnary of the parameters 
+        """
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None: 
+            return
+        if profiling_parameters.get('report'): 
+            profiler.save(profiling_parameters['report'])
+            print("Profiling report written in ", profiling_parameters['report'])
+        if profiling_parameters.get('summary'): 
+            print(profiler.summary())
+
     def getSkeletonData(self, filename): 
         """
             Reads centerlines data from the file and gets structered data as follows 
@@ -17,30 +58,105 @@ class BaseDigitalTwin:
 
                 branch = list of points coordinates
 
+            :filename : file path, a text skeleton or a binary ".npy" skeleton (see skeleton.py) 
+                        whose branches are returned as (n, 3) memory mapped array views
+        """
+        if filename.endswith('.npy'): 
+            return split_branches(*read_binary_skeleton(filename))
+
+        points, offsets = read_text_skeleton(filename)
+        return [branch.tolist() for branch in split_branches(points, offsets)]
+
+
+    def iterSkeletonData(self, filename): 
+        """
+            Reads centerlines data from a text or binary skeleton one branch at a time, 
+            each branch is a (n, 3) array. VGraph accepts it directly, so the whole file 
+            is never held in memory as text or nested lists. VGraph samples each branch as it is read 
+            and keeps its sample only, the branches of a binary skeleton are kept as memory mapped views
+
             :filename : file path 
         """
-        branches = []
-        branch = []
-        file = open(filename)
-        lines = file.readlines()
-        for line in lines: 
-            if line == "\n":
-                branches.append(branch)
-                branch = []
+        return iter_skeleton(filename)
 
-            else: 
-                line = line.split()
-                line = [float(val) for val in line]
-                branch.append(line)
-            
-        return branches
 
+    def getVesselModel(self, vessels_parameters): 
+        """
+            Gets the preprocessed vessel model: the bundle of vessels_parameters['bundle'] when it was 
+            built from the same skeleton and settings, otherwise the skeleton is read, the VGraph is 
+            built and the bundle is written for the next launch
 
-    def get_centerlines(self, loader, outputflie):
+            Both have the accessors used by the scene building, see VesselBundle 
+
+            :vessels_parameters : vessels dictionnary of the parameters 
+        """
+        skeleton = vessels_parameters['skeleton_output']
+        bundle_file = vessels_parameters.get('bundle')
+
+        if bundle_file: 
+            # Settings the bundle depends on, the skeleton is only hashed when there is a bundle
+            settings = {
+                'skeleton': VesselBundle.get_digest(skeleton), 
+                'sampling_rate': vessels_parameters['sampling_rate'], 
+                'sampling_mode': vessels_parameters['sampling_mode'], 
+                'adjacency_tolerance': vessels_parameters['adjacency_tolerance'], 
+                'frame_mode': vessels_parameters['frame_mode'], 
+                'adaptive_sampling': vessels_parameters.get('adaptive_sampling'), 
+            }
+
+            with self.stage("bundle load"): 
+                bundle = VesselBundle.load(bundle_file)
+            if bundle is not None and bundle.is_valid(settings): 
+                print("Vessel model loaded from ", bundle_file)
+                return bundle
+
+        # Beam data structure: "Beam", or "CompactBeam" that stores the samples and frames as arrays
+        beam_class = vessels_parameters.get('beam_class', 'Beam')
+        if beam_class not in BEAM_CLASSES: 
+            print("Error: unknown beam class ", beam_class, ", Beam is used")
+            beam_class = 'Beam'
+
+        # Structuring centerlines into polylines, read one branch at a time, and creating the Graph data structure. 
+        # The branches are sampled as they are read, by chunks in parallel when several workers are set
+        with self.stage("skeleton read and VGraph"): 
+            points = self.iterSkeletonData(skeleton)
+            vessel = VGraph(points, vessels_parameters['sampling_rate'], 
+                            beam_class=BEAM_CLASSES[beam_class], 
+                            sampling_mode=vessels_parameters['sampling_mode'], 
+                            tolerance=vessels_parameters['adjacency_tolerance'], 
+                            frame_mode=vessels_parameters['frame_mode'], 
+                            adaptive=vessels_parameters.get('adaptive_sampling'), 
+                            workers=vessels_parameters.get('workers', 1), 
+                            executor=vessels_parameters.get('executor', 'process'))
+
+        # Bezier fitting of the branches sampled in the calling thread, the workers fitted theirs
+        with self.stage("preprocess"): 
+            vessel.preprocess(vessels_parameters['sampling_rate'], 
+                              workers=vessels_parameters.get('workers', 1), 
+                              executor=vessels_parameters.get('executor', 'process'))
+
+        # Dofs saved, or added, by the adaptive sampling
+        if vessels_parameters['sampling_mode'] == 'adaptive': 
+            report = vessel.get_sampling_report(vessels_parameters['sampling_rate'])
+            change = round(100 * report['reduction'], 1)
+            change = str(change) + " % fewer" if change >= 0 else "+" + str(-change) + " % more"
+            print("Adaptive sampling: ", report['nodes'], " beam nodes instead of ", report['uniform_nodes'], 
+                  ", ", report['dofs'], " dofs instead of ", report['uniform_dofs'], ", ", change)
+
+        if bundle_file: 
+            with self.stage("bundle export"): 
+                VesselBundle.from_graph(vessel, settings).save(bundle_file)
+            print("Vessel model stored in ", bundle_file)
+
+        return vessel
+
+
+    def get_centerlines(self, loader, outputflie, use_cache=True):
         '''
             Apply the CGALSkeletonization Sofa plugin to get centerlines data
 
             :loader : Mesh file path 
+            :use_cache : reuse the skeleton of an unchanged mesh, cached in a "cache" folder next to the output file
         '''
         
         fileFormat = loader.split('.')[-1]
@@ -53,6 +169,22 @@ class BaseDigitalTwin:
         else: 
             print("Unknown file format ", fileFormat)
             return
+
+        # The skeleton only depends on the mesh bytes and on these settings
+        cache = None
+        if use_cache and os.path.exists(loader): 
+            cache = SkeletonCache(os.path.join(os.path.dirname(os.path.abspath(outputflie)), 'cache'))
+            key = cache.get_key(loader, {'loader': fileLoader, 'template': 'Vec3d', 'plugin': 'MeshSkeletonizationPlugin'})
+            if cache.load(key, outputflie): 
+                print("Skeleton cache: ", cache.report())
+                return
+
+        # Modification time of the output file before the skeletonization, a skeleton left by a previous mesh is never cached
+        previous = os.stat(outputflie).st_mtime_ns if os.path.exists(outputflie) else None
+
+        # Sofa is only needed here and in the scene building, the preprocessing runs without it
+        import Sofa.Core
+
         node = Sofa.Core.Node()
         node.addObject('RequiredPlugin', name='MeshSkeletonizationPlugin')
         node.addObject('RequiredPlugin', name='SofaGeneralLoader')
@@ -61,6 +193,13 @@ class BaseDigitalTwin:
         node.addObject('MeshSkeletonization', template="Vec3d", inputFile=outputflie,  name="skel", inputVertices="@MeshLoader.position", inputTriangles="@MeshLoader.triangles")
         node.init()
 
+        if cache is not None: 
+            if not os.path.exists(outputflie) or os.stat(outputflie).st_mtime_ns == previous: 
+                print("Error: the skeletonization did not write ", outputflie, ", nothing is cached")
+                return
+            cache.store(key, outputflie)
+            print("Skeleton cache: ", cache.report())
+
     def required(self, node): 
         """
             Adding Sofa required plugins 
@@ -126,10 +265,11 @@ class BaseDigitalTwin:
         graph = vessel.graph
         
 
-        # List of branchs 
-        branches = vessel.vaisseau
+        # Bezier curve fitting of all the branches at once: tangentes, normals and binormals
+        vessel.get_frames(vessels_parameter['sampling_rate'])
+
         # Modeling each vessel as a Beam using BeamForceField
-        for key, adjacents in graph.items(): 
+        for key in graph: 
 
             # Beam infos: index and name
             beam_index = int(key)
@@ -138,14 +278,14 @@ class BaseDigitalTwin:
             # Adding the beam to the graph node
             beam = graph_node.addChild(beam_name)
             
-            # Bezier curve fitting and sampling
-            beam_structure = Beam(branches[beam_index], vessels_parameter['sampling_rate'])
+            # Sampled beam, shared with the coupling and the mapping
+            beam_structure = vessel.get_beam(beam_index, vessels_parameter['sampling_rate'])
 
-            # Computing the quaternions and getting the MechanicalObject of the beam in the right format
+            # Computing the quaternions and getting the MechanicalObject of the beam: (N, 7) and (N, 3) arrays
             MO = beam_structure.get_MO_rigid()
             MO_vec = beam_structure.get_MO_vec()
 
-            # Getting the Topology of the beam, used in the BeamForceField
+            # Getting the Topology of the beam, used in the BeamForceField: (N-1, 2) edges
             topology = beam_structure.get_topology()
 
             # MechanicalObject templated on Rigdi3d, x y z quaterniion
@@ -158,14 +298,7 @@ class BaseDigitalTwin:
             beam.addObject('MeshTopology', name="topology", lines=topology)
 
             # Gets the indice of the will be fixed point of the vessel => Boudery Condition
-            if len(adjacents[0]) ==  0 and len(adjacents[1]) != 0: 
-                fixed_indices = "0"
-            elif len(adjacents[0]) != 0 and len(adjacents[1]) == 0:
-                fixed_indices = str(len(beam_structure.get_sample())-1)
-            elif len(adjacents[0]) == 0 and len(adjacents[1]) == 0:
-                fixed_indices = "0 " + str(len(beam_structure.get_sample())-1)
-            else: 
-                fixed_indices = ""
+            fixed_indices = vessel.get_fixed_indices(beam_index, vessels_parameter['sampling_rate'])
             
             # Boundery Condition
             if bc:
@@ -182,6 +315,61 @@ class BaseDigitalTwin:
 
         return graph_node
 
+    def VesselMonolithicModeling(self, graph_node, vessel, vessels_parameter, bc=False):
+        """
+            Given a vessel tree, here we model the whole tree as a single Beam: one Rigid3d MechanicalObject, 
+            one edge topology and one BeamFEMForceField. Branches share their node at bifurcations, 
+            so no coupling springs are needed
+
+            The branches are oriented away from a root and a shared node keeps the orientation of the parent 
+            branch, see VGraph.get_tree: its x axis is the tangente of the parent at its end. BeamFEMForceField 
+            assumes that an element lies along the x axis of its nodes, so the first element of a child branch 
+            is off axis by the branching angle, which changes its bending and axial response. A warning gives 
+            the number of elements more than MISALIGNMENT_WARNING degrees off axis
+
+            The mass is vessels_parameter['totalMass'] per branch, as in VesselMechanicalModeling, 
+            so that both models carry the same total mass
+        """
+        # Bezier curve fitting of all the branches, and assembly of the tree with shared bifurcation nodes
+        MO, topology, nodes, fixed_indices = vessel.get_tree(vessels_parameter['sampling_rate'])
+
+        # Elements off the x axis of their nodes, the children at the bifurcations
+        misalignment = get_misalignment(MO, topology)
+        off_axis = np.count_nonzero(misalignment > MISALIGNMENT_WARNING)
+        if off_axis: 
+            print("Warning: ", off_axis, " of ", len(misalignment), " tree elements are more than ", MISALIGNMENT_WARNING, 
+                  " degrees off the axis of their nodes, up to ", round(float(misalignment.max()), 1), " degrees, see VGraph.get_tree")
+
+        # Same total mass as one UniformMass per branch in VesselMechanicalModeling
+        total_mass = float(vessels_parameter['totalMass']) * len(nodes)
+
+        # Adding the tree to the graph node
+        tree = graph_node.addChild('tree')
+
+        # MechanicalObject templated on Rigdi3d, x y z quaterniion
+        tree.addObject('MechanicalObject', name="mo", template="Rigid3d", position=MO)
+        
+        # Uniform mass 
+        tree.addObject('UniformMass', totalMass=total_mass, showAxisSizeFactor=vessels_parameter['showAxisSizeFactor'])
+        
+        # Mesh Topology of all the branches
+        tree.addObject('MeshTopology', name="topology", lines=topology)
+
+        # Boundery Condition on the free extremities of the tree
+        if bc:
+            tree.addObject("FixedConstraint", name="bc", indices=fixed_indices)
+        
+        # BeamForceField defines the FEM model of the tree
+        tree.addObject('BeamFEMForceField', name="FEM", radius=vessels_parameter['radius'], radiusInner=vessels_parameter['radiusInner'],  youngModulus=vessels_parameter['young_modulus'], poissonRatio=vessels_parameter['poissonRatio'] )
+        
+        # Beam Vec: only x y z dofs of the tree, used to map the tree with the Parenchyma
+        beam_vec = tree.addChild('beam_vec')
+        beam_vec.addObject('MechanicalObject', name="beam_vec_mo", position=np.ascontiguousarray(MO[:, :3]))
+        beam_vec.addObject('UniformMass', totalMass=total_mass, showAxisSizeFactor=vessels_parameter['showAxisSizeFactor'])
+        beam_vec.addObject('IdentityMapping')
+
+        return graph_node
+
     def addVessels(self, node, vessels_parameters):
         """
             Loading vessel mesh and adding visualisatio
@@ -203,72 +391,37 @@ class BaseDigitalTwin:
         # Graph structure
         graph = vessel.graph
 
-        # List of branchs 
-        branches = vessel.vaisseau
+        # Indexes of the biforcations in the source and target beams
+        bifurcations = vessel.get_bifurcations(vessels_parameter['sampling_rate'])
+
         # Mechanical coupling between beams
         for key, adjacents in graph.items(): 
 
             # Curent beam infos: index and name
             beam_index = int(key)
 
-            # Source Beam structure
-            beam_structure = Beam(branches[beam_index], vessels_parameter['sampling_rate'])
-            vertices = beam_structure.get_vertices()
+            # Iterate on both extremities of the vessel to find other connected vessels and do the mechanical coupling
+            for extremity in range(2): 
+                for elem in adjacents[extremity]: 
 
-            # Iterate on the first extremity of the vessel to find other connected vessels and do the mechanical coupling
-            for elem in adjacents[0]: 
+                    # Target Beam infos
+                    external_rest_shape = "@../beam" + str(elem) + "/mo" 
 
-                # Target Beam infos
-                external_rest_shape = "@../beam" + str(elem) + "/mo" 
-                beam_target = Beam(branches[elem], vessels_parameter['sampling_rate'])
+                    # Indexes of the biforcation in the  source and target beams
+                    if (beam_index, extremity, elem) not in bifurcations: 
+                        continue
+                    indices1, indices2 = bifurcations[(beam_index, extremity, elem)]
 
-                # Get the biforcation point 
-                biforcation = vertices[0]
+                    # Spring name describes its rool 
+                    spring_name = "join_beam" + key + " and beam" + str(elem)
 
-                # Indexes of the biforcation in the  source and target beams
-                indices1 = beam_structure.get_index_bif(biforcation)
-                indices2 = beam_target.get_index_bif(biforcation)
+                    # Get the Source beam Sofa Node
+                    this_beam = graph_node.getChild("beam" + key)
 
-                # Spring name describe its rool 
-                spring_name = "join_beam" + key + " and beam" + str(elem)
-
-                # Source beam infos
-                this_beam_name = "beam" + key
-                
-                # Get the Source beam Sofa Node
-                this_beam = graph_node.getChild(this_beam_name)
-                
-                # Coupling source and target beam with a Spring using RestShapeSpringsForceField
-                this_beam.addObject('RestShapeSpringsForceField', name=spring_name, stiffness="1000", angularStiffness="10", external_rest_shape=external_rest_shape,  points=indices1, external_points=indices2)
-            
-
-            # Iterating on the second extremity of the vessel 
-            for elem in adjacents[1]:
-
-                # Target Beam infos                    
-                external_rest_shape = "@../beam" + str(elem)  + "/mo"
-                beam_target = Beam(branches[elem], vessels_parameter['sampling_rate'])
-
-                # Gets the biforcation point 
-                biforcation = vertices[1]
-
-                # Indexes of the biforcation in the  source and target beams
-                indices1 = beam_structure.get_index_bif(biforcation)
-                indices2 = beam_target.get_index_bif(biforcation)
-
-                # Spring name describes its rool 
-                spring_name = "join_beam" + key + " and beam" + str(elem)
-
-                # Source beam name
-                this_beam_name = "beam" + key
-
-                # Get the Source beam Sofa Node
-                this_beam = graph_node.getChild(this_beam_name)
-
-                # Coupling source and target beam with a Spring using RestShapeSpringsForceField
-                this_beam.addObject('RestShapeSpringsForceField', name=spring_name, 
-                                stiffness=vessels_parameter['vesselsCoupling']['stiffness'], 
-                                angularStiffness=vessels_parameter['vesselsCoupling']['angularStiffness'], external_rest_shape=external_rest_shape,  points=indices1, external_points=indices2)
+                    # Coupling source and target beam with a Spring using RestShapeSpringsForceField
+                    this_beam.addObject('RestShapeSpringsForceField', name=spring_name, 
+                                    stiffness=vessels_parameter['vesselsCoupling']['stiffness'], 
+                                    angularStiffness=vessels_parameter['vesselsCoupling']['angularStiffness'], external_rest_shape=external_rest_shape,  points=indices1, external_points=indices2)
                 
         return graph_node
 
@@ -277,13 +430,20 @@ class BaseDigitalTwin:
     def LiverToVesselMapping(self, node, vessel, parenchyma_parameters, vessels_parameters, mapping_parameters):
         """
             Given a parenchyma and vessel node, here we map both using springs. Thus, creating the digital twin
+
+            mapping_parameters['mode'] = "per_branch" (default): one target node per branch and one spring component per node
+                                         "merged": all the branches in one target, see MergedLiverToVesselMapping
+
+            A monolithic vessel tree is always mapped in "merged" mode
         """
+        if mapping_parameters.get('mode', 'per_branch') == 'merged' or vessels_parameters.get('model') == 'monolithic': 
+            return self.MergedLiverToVesselMapping(node, vessel, parenchyma_parameters, vessels_parameters, mapping_parameters)
+
         # Getting the parenchyma node
         parenchyma = node.getChild("parenchyma")
 
         # Graph tree 
         graph = vessel.graph
-        branches = vessel.vaisseau
 
         # Target Beam Vec
         target = parenchyma.addChild('target')
@@ -298,7 +458,7 @@ class BaseDigitalTwin:
             beam = target.addChild(beam_name)
             
             # Getting the MechanicalObject Vec3d infos
-            beam_structure = Beam(branches[beam_index], vessels_parameters['sampling_rate'])
+            beam_structure = vessel.get_beam(beam_index, vessels_parameters['sampling_rate'])
             MO_vec = beam_structure.get_MO_vec()
             beam.addObject('MechanicalObject', name='mo', template="Vec3d", position=MO_vec)
             
@@ -312,4 +472,82 @@ class BaseDigitalTwin:
         
             # Mapping The BeamVec with the Parenchyma 
             beam.addObject('BarycentricMapping', input="@../../dofs", output='@.')
-        return parenchyma
\ No newline at end of file
+        return parenchyma
+
+
+    def MergedLiverToVesselMapping(self, node, vessel, parenchyma_parameters, vessels_parameters, mapping_parameters):
+        """
+            Maps the parenchyma and the vessels with a constant number of components: 
+
+                - vessels side: one "vessels_vec" node, child of every beam_vec, gathers all the vessel nodes with a SubsetMultiMapping, 
+                  a monolithic tree already has them in its beam_vec
+
+                - parenchyma side: one target MechanicalObject holding all the vessel nodes and one BarycentricMapping
+
+                - one StiffSpringForceField holding a spring per vessel node, its stiffness, damping and rest length 
+                  are parsed once from mapping_parameters['stiffness'] and the spring data is built from the node indices
+        """
+        # Getting the parenchyma and the vessels graph nodes
+        parenchyma = node.getChild("parenchyma")
+        graph_node = node.getChild("vessels").getChild("Graphe_node")
+
+        if vessels_parameters.get('model') == 'monolithic': 
+            # The tree beam_vec already holds all the vessel nodes, their positions are taken from it
+            positions = graph_node.getChild('tree').getChild('beam_vec').getObject('beam_vec_mo').position.value
+            myobject1 = "@/vessels/Graphe_node/tree/beam_vec"
+        else: 
+            positions, myobject1 = self.MergedVesselVec(graph_node, vessel, vessels_parameters)
+
+        # Parenchyma side: one target holding all the vessel nodes
+        target = parenchyma.addChild('target')
+        target.addObject('MechanicalObject', name='mo', template="Vec3d", position=positions)
+
+        # One spring per vessel node in a single component, "index index stiffness damping restLength" as the 
+        # spring data of StiffSpringForceField, mapping_parameters['stiffness'] is "stiffness damping restLength"
+        stiffness, damping, rest_length = [float(value) for value in mapping_parameters['stiffness'].split()]
+        parameters = " {} {} {}".format(stiffness, damping, rest_length)
+        indices = np.arange(len(positions)).astype(str)
+        springs = " ".join(np.char.add(np.char.add(np.char.add(indices, " "), indices), parameters))
+        target.addObject('StiffSpringForceField', name="vessels_springs", template="Vec3d", spring=springs, object1=myobject1, object2="@./")
+
+        # Mapping the target with the Parenchyma 
+        target.addObject('BarycentricMapping', input="@../dofs", output='@.')
+        return parenchyma
+
+
+    def MergedVesselVec(self, graph_node, vessel, vessels_parameters):
+        """
+            Gathers the beam_vec of all the beams into a single "vessels_vec" node, child of every beam_vec, 
+            with a SubsetMultiMapping. Returns the positions of all the vessel nodes and the path of the node
+        """
+        # Graph tree 
+        graph = vessel.graph
+
+        # Positions of all the vessel nodes, and (beam, node) index pairs of the multi mapping
+        positions = []
+        index_pairs = []
+        inputs = []
+        vessels_vec = None
+        for input_index, key in enumerate(graph): 
+
+            # Current beam infos
+            beam_structure = vessel.get_beam(int(key), vessels_parameters['sampling_rate'])
+            positions.append(beam_structure.get_MO_vec())
+            index_pairs.append(np.stack([np.full(beam_structure.num_nodes, input_index), np.arange(beam_structure.num_nodes)], axis=1))
+            inputs.append("@/vessels/Graphe_node/beam" + key + "/beam_vec/beam_vec_mo")
+
+            # The merged node has every beam_vec as parent
+            beam_vec = graph_node.getChild("beam" + key).getChild("beam_vec")
+            if vessels_vec is None: 
+                vessels_vec = beam_vec.addChild("vessels_vec")
+            else: 
+                beam_vec.addChild(vessels_vec)
+
+        positions = np.concatenate(positions)
+        index_pairs = np.concatenate(index_pairs)
+
+        # Vessels side: all the beam_vec nodes gathered in one MechanicalObject
+        vessels_vec.addObject('MechanicalObject', name="mo", template="Vec3d", position=positions)
+        vessels_vec.addObject('SubsetMultiMapping', template="Vec3d,Vec3d", input=" ".join(inputs), output="@./", indexPairs=index_pairs.ravel())
+
+        return positions, "@/vessels/Graphe_node/beam" + next(iter(graph)) + "/beam_vec/vessels_vec"
@@ -1,9 +1,8 @@
 import numpy as np
-from pyquaternion import Quaternion
 import math
 
 
-from bezier import Bezier
+from bezier import Bezier, BezierBatch
 
 
 class Beam: 
@@ -11,40 +10,76 @@ class Beam:
     Data structure for a Beam
     :branche : a list of points 
     :sampling_rate : desired distance between two points in the branch
+    :mode : sampling mode, "arclength" places the nodes at a uniform spacing along 
+            the polyline, "adaptive" adapts the spacing to the curvature, 
+            "legacy" keeps the greedy point selection
+    :frame_mode : "rmf" or "random", how the normals are built, see Bezier
+    :adaptive : settings of the "adaptive" mode, see get_adaptive_sample
     """
     #Initializer
-    def __init__(self, branche, sampling_rate):
+    def __init__(self, branche, sampling_rate, mode="arclength", frame_mode="rmf", adaptive=None):
         self.branche = branche
         self.sampling_rate = sampling_rate
+        self.mode = mode
+        self.frame_mode = frame_mode
+        self.adaptive = adaptive
         self.sample = self.get_sample()
         self.vertices = self.get_vertices()
         self.num_nodes = len(self.sample)
 
+        # Computed once, on demand
+        self.frames = None
+        self.topology = None
 
-    def get_topology(self): 
+
+    def get_topology(self, as_string=False): 
         """ 
-        Get the topology of the beam
+        Get the topology of the beam: the (N-1, 2) array of its edges
+
+        :as_string : returns the Sofa string instead, for debugging
         """ 
-        longuer = len(self.sample)
+        if self.topology is None:
+            index = np.arange(max(len(self.sample) - 1, 0))
+            self.topology = np.stack([index, index + 1], axis=1)
 
-        topology = ""
-        for i in range(longuer-1): 
-            topology += str(i) + " " + str(i+1) + " "
+        if as_string: 
+            return self.to_string(self.topology)
+        return self.topology
+    
 
-        return topology
+    def to_string(self, data): 
+        """ 
+        Formats an array as a space separated Sofa string, used as a debug export
+        """ 
+        data = np.asarray(data).ravel()
+        if not len(data): 
+            return ""
+        return " ".join(map(str, data.tolist())) + " "
     
 
     def get_sample(self): 
         """ 
-        Sampling the beam, according to the choosed sampling rate 
+        Sampling the beam, according to the choosed sampling rate and mode
+        """ 
+        if self.mode == "legacy": 
+            return self.get_legacy_sample()
+        if self.mode == "adaptive": 
+            return self.get_adaptive_sample().tolist()
+        return self.get_arclength_sample().tolist()
+    
+
+    def get_legacy_sample(self): 
+        """ 
+        Greedy sampling: a point of the branch is kept when it is at least 
+        one sampling rate away from the last kept point
         """ 
         sample = []
-        branche = self.branche
+        branche = np.asarray(self.branche).tolist()
         next_value = branche[0]
         sampler = self.sampling_rate
         sample.append(next_value)
-        for i in range(1, len(self.branche)):
-            next_value = self.branche[i]
+        for i in range(1, len(branche)):
+            next_value = branche[i]
             norm = self.get_distance(sample[len(sample)-1], next_value)
             if norm >= sampler:
                 sample.append(next_value)
@@ -57,6 +92,118 @@ class Beam:
         if branche[-1] not in sample: 
             sample.append(branche[-1])
         return sample
+    
+
+    def get_abscissa(self): 
+        """ 
+        Gets the branch as a (n, 3) array, the length of its segments and the cumulative length at each point
+        """ 
+        branche = np.asarray(self.branche, dtype=np.float64).reshape(-1, 3)
+        segments = np.linalg.norm(np.diff(branche, axis=0), axis=1)
+        abscissa = np.concatenate([[0], np.cumsum(segments)])
+        return branche, segments, abscissa
+
+
+    def get_points_at(self, branche, segments, abscissa, targets): 
+        """ 
+        Interpolates the points of the polyline at the given cumulative lengths, 
+        the two extremities of the branch are kept as they are
+        """ 
+        # Segment of the polyline holding each target and position on this segment
+        index = np.clip(np.searchsorted(abscissa, targets, side='right') - 1, 0, len(segments) - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(segments[index] > 0, (targets - abscissa[index]) / segments[index], 0)
+
+        sample = branche[index] + ratio[:, None] * (branche[index + 1] - branche[index])
+        sample[0] = branche[0]
+        sample[-1] = branche[-1]
+
+        return sample
+
+
+    def get_arclength_sample(self): 
+        """ 
+        Arc length sampling in O(n): the cumulative length of the polyline is computed once 
+        and round(length / sampling rate) segments of equal length are placed on it 
+        by interpolation, the two extremities of the branch are kept as they are
+        """ 
+        branche, segments, abscissa = self.get_abscissa()
+        length = abscissa[-1]
+
+        if length == 0: 
+            return branche[:1].copy()
+
+        number_of_segments = max(1, int(round(length / self.sampling_rate)))
+        targets = np.linspace(0, length, number_of_segments + 1)
+
+        return self.get_points_at(branche, segments, abscissa, targets)
+
+
+    def get_adaptive_settings(self): 
+        """ 
+        Settings of the adaptive sampling, the missing ones are relative to the sampling rate: 
+
+            min_spacing: smallest distance between two nodes, sampling rate / 2 by default
+
+            max_spacing: largest distance between two nodes, 4 sampling rates by default
+
+            tolerance: largest distance between the curve and a beam element, sampling rate / 10 by default
+
+            bifurcation_distance: nodes are placed at sampling rate steps this close to an extremity, where the 
+                                  branches meet, at least one step is kept, sampling rate by default
+        """ 
+        rate = self.sampling_rate
+        settings = {'min_spacing': rate / 2, 'max_spacing': 4 * rate, 'tolerance': rate / 10, 'bifurcation_distance': rate}
+        settings.update(self.adaptive or {})
+        return settings
+
+
+    def get_adaptive_sample(self): 
+        """ 
+        Curvature adaptive sampling: an element of length h on an arc of curvature k is at most 
+        h^2 k / 8 away from it, so the spacing at each point of the branch is sqrt(8 tolerance / k), 
+        with k the curvature of the Bezier curve fitted on the branch, bounded by the min and max spacing. 
+        Near the extremities, where the branches meet, the nodes are placed at sampling rate steps, so the 
+        end elements are never longer than the sampling rate. In between, the nodes are placed at equal 
+        steps of the number of nodes per length, integrated along the branch
+        """ 
+        settings = self.get_adaptive_settings()
+        branche, segments, abscissa = self.get_abscissa()
+        length = abscissa[-1]
+
+        if length == 0: 
+            return branche[:1].copy()
+
+        # Nodes at sampling rate steps from each extremity, at least one step
+        rate = self.sampling_rate
+        end_steps = max(1, int(np.ceil(settings['bifurcation_distance'] / rate - 1e-9)))
+        start, stop = end_steps * rate, length - end_steps * rate
+
+        # Short branch: uniform sampling, the elements are at most the sampling rate
+        if stop - start < settings['min_spacing']: 
+            targets = np.linspace(0, length, max(1, int(np.ceil(length / rate - 1e-9))) + 1)
+            return self.get_points_at(branche, segments, abscissa, targets)
+
+        # The curvature is measured on the branch resampled at the min spacing, 
+        # so that the noise of the centerline points does not look like bends
+        steps = np.linspace(0, length, max(2, int(round(length / settings['min_spacing'])) + 1))
+        curvature = Bezier(self.get_points_at(branche, segments, abscissa, steps)).get_curvatures()
+
+        # Spacing allowed along the branch
+        with np.errstate(divide='ignore'):
+            spacing = np.sqrt(8 * settings['tolerance'] / curvature)
+        spacing = np.clip(spacing, settings['min_spacing'], settings['max_spacing'])
+
+        # Cumulative number of nodes along the branch, the nodes between the extremity steps are at its integer steps
+        density = 1 / spacing
+        nodes = np.concatenate([[0], np.cumsum(0.5 * (density[1:] + density[:-1]) * np.diff(steps))])
+        first, last = np.interp([start, stop], steps, nodes)
+        number_of_segments = max(1, int(np.ceil(last - first - 1e-9)))
+        middle = np.interp(np.linspace(first, last, number_of_segments + 1), nodes, steps)
+        middle[0], middle[-1] = start, stop
+
+        targets = np.concatenate([rate * np.arange(end_steps), middle, length - rate * np.arange(end_steps)[::-1]])
+        return self.get_points_at(branche, segments, abscissa, targets)
 
     
     def get_norm(self, point):
@@ -88,71 +235,113 @@ class Beam:
     
     def get_quaternion(self, tangente, normal, binormal):
         """
-        Get The quaternion given a rotation matrix,
-        This function should be added to a Helper
+        Get The quaternion given a rotation matrix, in Sofa order (x, y, z, w)
         """
-        rotation = np.array([
-                            [tangente[0], normal[0], binormal[0]],
-                            [tangente[1], normal[1], binormal[1]], 
-                            [tangente[2], normal[2], binormal[2]]
-                            
-                        ])
+        return self.get_quaternions([tangente], [normal], [binormal])[0]
+
+
+    def get_quaternions(self, tangentes, normals, binormals):
+        """
+        Get the quaternions of a set of frames in one pass, in Sofa order (x, y, z, w)
+
+        The rotation matrices have the tangente, normal and binormal as columns, 
+        they are stacked in a (N, 3, 3) array and converted with Shepperd's method: 
+        the largest of w, x, y, z is computed first to keep the division stable
+        """
+        rotations = np.stack([np.asarray(tangentes, dtype=np.float64).reshape(-1, 3), 
+                              np.asarray(normals, dtype=np.float64).reshape(-1, 3), 
+                              np.asarray(binormals, dtype=np.float64).reshape(-1, 3)], axis=2)
+
+        m00, m01, m02 = rotations[:, 0, 0], rotations[:, 0, 1], rotations[:, 0, 2]
+        m10, m11, m12 = rotations[:, 1, 0], rotations[:, 1, 1], rotations[:, 1, 2]
+        m20, m21, m22 = rotations[:, 2, 0], rotations[:, 2, 1], rotations[:, 2, 2]
 
-        quaternion = Quaternion(matrix=rotation)
+        # 4w^2, 4x^2, 4y^2 and 4z^2 
+        squares = np.stack([1 + m00 + m11 + m22, 
+                            1 + m00 - m11 - m22, 
+                            1 - m00 + m11 - m22, 
+                            1 - m00 - m11 + m22], axis=1)
+        largest = np.argmax(squares, axis=1)
+        s = 2 * np.sqrt(np.maximum(squares[np.arange(len(largest)), largest], 1e-300))
 
-        return quaternion
+        # Each row is (x, y, z, w) * s for one choice of the largest component
+        candidates = np.stack([
+            np.stack([m21 - m12, m02 - m20, m10 - m01, s * s / 4], axis=1),
+            np.stack([s * s / 4, m01 + m10, m02 + m20, m21 - m12], axis=1),
+            np.stack([m01 + m10, s * s / 4, m12 + m21, m02 - m20], axis=1),
+            np.stack([m02 + m20, m12 + m21, s * s / 4, m10 - m01], axis=1)], axis=1)
+
+        quaternions = candidates[np.arange(len(largest)), largest] / s[:, None]
+        quaternions = quaternions / np.linalg.norm(quaternions, axis=1)[:, None]
+
+        # q and -q are the same rotation, w is kept positive
+        quaternions[quaternions[:, 3] < 0] *= -1
+
+        return quaternions
 
 
     
-    def get_MO_rigid(self): 
+    def get_frames(self): 
         """
-        Compute the Mechanical Object string of the branch: positions + rotations(represented as a quaternion)
+        Fits a Bezier curve on the sample and gets the (tangentes, normals, binormals) 
+        at each sampled point, they are computed once and kept on the beam
         """
-        sampled_data = self.sample
-        MO = ""
+        if self.frames is None:
+            sampled_data = self.sample
+
+            bezier = Bezier(sampled_data, self.frame_mode)
+            try:
+                tangentes = bezier.get_tangentes()
+            except:
+                print("--- Brache ---")
+                print(self.branche)
+                print("--- Sampled ---")
+                print(sampled_data)
+                print("-----")
+                
+            normals = bezier.get_normals(tangentes)
+            binormals = bezier.get_binormals(tangentes, normals)
+
+            self.frames = (tangentes, normals, binormals)
 
-        bezier = Bezier(sampled_data)
-        try:
-            tangentes = bezier.get_tangentes()
-        except:
-            print("--- Brache ---")
-            print(self.branche)
-            print("--- Sampled ---")
-            print(sampled_data)
-            print("-----")
-            
-        normals = bezier.get_normals(tangentes)
-        binormals = bezier.get_binormals(tangentes, normals)
+        return self.frames
 
-        list_of_x, list_of_y, list_of_z = self.get_list_of_xyz()
+    
+    def get_MO_rigid(self, frames=None, as_string=False): 
+        """
+        Compute the Mechanical Object of the branch: positions + rotations(represented as a quaternion), 
+        as a (N, 7) array of x y z qx qy qz qw
+
+        :frames : optional (tangentes, normals, binormals) already computed for the sample, 
+                  the beam frames by default
+        :as_string : returns the Sofa string instead, for debugging
+        """
+        if frames is None:
+            frames = self.get_frames()
+        tangentes, normals, binormals = frames
 
         if not (len(tangentes) == len(normals) and len(normals) == len(binormals)): 
             print("Error: Index out of range, len of tangentes, normals and binormals are not equal")
-        else: 
-            longueur = len(tangentes)
-            for i in range(longueur): 
-                quaternion = self.get_quaternion(tangentes[i], normals[i], binormals[i])
-                
-                quat_i_0 = quaternion[1]
-                quat_i_1 = quaternion[2]
-                quat_i_2 = quaternion[3]
-                quat_i_3 = quaternion[0]
+            return
 
-                MO += str(list_of_x[i]) + " " + str(list_of_y[i]) + " " + str(list_of_z[i]) + " " + str(quat_i_0) + " " + str(quat_i_1) + " " + str(quat_i_2) + " " + str(quat_i_3) + " "
+        quaternions = self.get_quaternions(tangentes, normals, binormals)
+        MO = np.hstack([self.get_MO_vec(), quaternions])
+
+        if as_string: 
+            return self.to_string(MO)
         return MO
 
     
-    def get_MO_vec(self): 
-        """
-        Compute the Mechanical Object string of the branch: only the positions
+    def get_MO_vec(self, as_string=False): 
         """
-        
-        MO = ""
-        list_of_x, list_of_y, list_of_z = self.get_list_of_xyz()
+        Compute the Mechanical Object of the branch: only the positions, as a (N, 3) array
 
-        for i in range(len(list_of_x)): 
+        :as_string : returns the Sofa string instead, for debugging
+        """
+        MO = np.asarray(self.sample, dtype=np.float64).reshape(-1, 3)
 
-            MO += str(list_of_x[i]) + " " + str(list_of_y[i]) + " " + str(list_of_z[i]) + " " 
+        if as_string: 
+            return self.to_string(MO)
         return MO
     
     def get_vertices(self):
@@ -210,4 +399,162 @@ class Beam:
         box = str(min_x-slicing) + " " + str(min_y-slicing) + " " + str(min_z-slicing) + " " + str(max_x+slicing) + " " + str(max_y+slicing) + " " + str(max_z+slicing) + " "
 
         return box
-                
\ No newline at end of file
+                
+
+
+class CompactBeam: 
+    """
+    Compact data structure for a Beam, the branch and its sample are stored 
+    as contiguous (N, 3) float64 arrays and all the geometry is vectorized
+    :branche : a list or an array of points 
+    :sampling_rate : desired distance between two points in the branch
+    :mode : sampling mode, "arclength", "adaptive" or "legacy", see Beam
+    :frame_mode : "rmf" or "random", see Bezier
+    :adaptive : settings of the "adaptive" mode, see Beam.get_adaptive_sample
+    """
+    __slots__ = ('branche', 'sampling_rate', 'mode', 'frame_mode', 'adaptive', 'sample', 'vertices', 'num_nodes', 'frames', 'topology')
+
+    #Initializer
+    def __init__(self, branche, sampling_rate, mode="arclength", frame_mode="rmf", adaptive=None):
+        self.branche = np.ascontiguousarray(branche, dtype=np.float64).reshape(-1, 3)
+        self.sampling_rate = sampling_rate
+        self.mode = mode
+        self.frame_mode = frame_mode
+        self.adaptive = adaptive
+        self.sample = self.get_sample()
+        self.vertices = self.get_vertices()
+        self.num_nodes = len(self.sample)
+
+        # Computed once, on demand
+        self.frames = None
+        self.topology = None
+
+
+    get_topology = Beam.get_topology
+
+    to_string = Beam.to_string
+
+
+    def get_sample(self): 
+        """ 
+        Sampling the beam, according to the choosed sampling rate and mode
+        """ 
+        if self.mode == "legacy": 
+            return self.get_legacy_sample()
+        if self.mode == "adaptive": 
+            return self.get_adaptive_sample()
+        return self.get_arclength_sample()
+
+
+    get_abscissa = Beam.get_abscissa
+
+    get_points_at = Beam.get_points_at
+
+    get_arclength_sample = Beam.get_arclength_sample
+
+    get_adaptive_settings = Beam.get_adaptive_settings
+
+    get_adaptive_sample = Beam.get_adaptive_sample
+
+
+    def get_legacy_sample(self): 
+        """ 
+        Greedy sampling: same points as Beam.get_legacy_sample, the next point 
+        is searched in growing windows instead of point by point
+        """ 
+        branche = self.branche
+        length = len(branche)
+        indices = [0]
+        current = 0
+        while current < length - 1: 
+            window = 8
+            while True: 
+                stop = min(current + 1 + window, length)
+                distance = self.get_distance(branche[current + 1:stop], branche[current])
+                far = np.flatnonzero(distance >= self.sampling_rate)
+                if len(far) or stop == length: 
+                    break
+                window *= 2
+            if not len(far): 
+                break
+            current = current + 1 + int(far[0])
+            indices.append(current)
+
+        sample = branche[indices]
+        if not np.any(np.all(sample == branche[-1], axis=1)): 
+            sample = np.vstack([sample, branche[-1]])
+        return sample
+
+    
+    def get_norm(self, point):
+        """ 
+        Computes norm 2, of a point or of each row of an array of points
+        """ 
+        return np.sqrt(np.sum(np.square(point), axis=-1))
+    
+    def get_distance(self, point1, point2):
+        """ 
+        Computes distant between two points, or between arrays of points
+        """ 
+        return self.get_norm(np.subtract(point1, point2))
+    
+
+    def get_list_of_xyz(self):
+        """
+        Get list of coordonates, as views on the sample
+        """
+        return self.sample[:, 0], self.sample[:, 1], self.sample[:, 2]
+
+
+    get_quaternion = Beam.get_quaternion
+
+    get_quaternions = Beam.get_quaternions
+
+
+    def get_frames(self):
+        """
+        Fits a Bezier curve on the sample and gets the (tangentes, normals, binormals)
+        at each sampled point as three (N, 3) arrays, they are computed once and kept on the beam
+        """
+        if self.frames is None:
+            tangentes, normals, binormals = BezierBatch(self.sample, [0, self.num_nodes], self.frame_mode).get_frames()
+            self.frames = (tangentes[0], normals[0], binormals[0])
+
+        return self.frames
+
+
+    get_MO_rigid = Beam.get_MO_rigid
+
+    get_MO_vec = Beam.get_MO_vec
+
+    
+    def get_vertices(self):
+        """ 
+        Get the coordonates of the beam vertices
+        """
+        return  [self.sample[0], self.sample[-1]]
+    
+
+    def get_index_bif(self, bif): 
+        """
+        Geting the index of the bifurcation
+        """
+        found = np.flatnonzero(np.all(self.sample == np.asarray(bif), axis=1))
+        if not len(found): 
+            print("Error: Bifurcation not in branche")
+            return
+        return str(found[0])
+    
+    
+    def get_box_coordonates(self): 
+        """
+        Geting the box ROI coordinates: the bounding box of a branch
+        """
+        slicing = 0.001
+        box = np.concatenate([self.sample.min(axis=0) - slicing, self.sample.max(axis=0) + slicing])
+
+        return self.to_string(box)
+
+
+# Beam data structures, selected by name with vessels['beam_class']
+BEAM_CLASSES = {'Beam': Beam, 'CompactBeam': CompactBeam}
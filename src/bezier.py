@@ -12,47 +12,87 @@ class Bezier:
     This class process a list of points in order to approximate 
     a Bezier Cubic curve, it also computes the tangentes, normals 
     and binormals at each point
+    :points : a list of points 
+    :frame_mode : "rmf" for deterministic rotation minimizing frames, 
+                  "random" for normals built from a random reference vector
     """
+
+    # Bernstein basis matrices, shared by all the curves and keyed by the grid size
+    basis_cache = {}
     
-    def __init__(self, points):
+    def __init__(self, points, frame_mode="rmf"):
         # Initializer
         self.points = points
+        self.frame_mode = frame_mode
 
-    def get_bezier_coef(self):
-        """
-        Gets the Control points coefficients
+        # Control points (A, B), solved once and reused by every query
+        self.coef = None
+
+    @staticmethod
+    def solve_tridiagonal(lower, diag, upper, rhs):
         """
-        points = self.points
-        n = len(points) - 1
-
-        C = 4 * np.identity(n) 
-        np.fill_diagonal(C[1:], 1)
-        np.fill_diagonal(C[:, 1:], 1)
-        C[0, 0] = 2
-        C[n - 1, n - 1] = 7
-        C[n - 1, n - 2] = 2
-        
-        P = []
-        for i in range(0, n):
-            tmp = [4*points[i][0] + 2*points[i+1][0], 4*points[i][1] + 2*points[i+1][1], 4*points[i][2] + 2*points[i+1][2]]
-            P.append(tmp)
-        
-        P[0] = [points[0][0] + 2*points[1][0], points[0][1] + 2*points[1][1], points[0][2] + 2*points[1][2]]
-        P[n - 1] = [8*points[n - 1][0] + points[n][0], 8*points[n - 1][1] + points[n][1], 8*points[n - 1][2] + points[n][2]]
+        Solves the tridiagonal system of one curve with the Thomas algorithm in O(n), 
+        the systems of several branches are solved by BezierBatch.solve_ragged_tridiagonal
 
-        P = np.asarray(P)
+        :lower : sub-diagonal, shape (n - 1,)
+        :diag : main diagonal, shape (n,)
+        :upper : super-diagonal, shape (n - 1,)
+        :rhs : right hand side, shape (n, 3)
+        """
+        n = len(diag)
+        c = np.zeros(n)
+        d = np.zeros(rhs.shape)
 
+        if n > 1:
+            c[0] = upper[0] / diag[0]
+        d[0] = rhs[0] / diag[0]
+        for i in range(1, n):
+            denom = diag[i] - lower[i - 1] * c[i - 1]
+            if i < n - 1:
+                c[i] = upper[i] / denom
+            d[i] = (rhs[i] - lower[i - 1] * d[i - 1]) / denom
 
-        A = np.linalg.solve(C, P)
-        B = []
-        for i in range(n):
-            B.append([0, 0, 0])
+        for i in range(n - 2, -1, -1):
+            d[i] = d[i] - c[i] * d[i + 1]
 
-        for i in range(n - 1):
-            B[i] = [2*points[i+1][0] - A[i+1][0], 2*points[i+1][1] - A[i+1][1], 2*points[i+1][2] - A[i+1][2]]
-        B[n - 1] = [(A[n-1][0] + points[n][0])/2, (A[n - 1][1] + points[n][1])/2, (A[n - 1][2] + points[n][2])/2]
+        return d
 
-        return A, B
+    def get_bezier_coef(self):
+        """
+        Gets the Control points coefficients, the system is solved once per curve
+        """
+        if self.coef is None:
+            points = np.asarray(self.points, dtype=np.float64)
+            n = len(points) - 1
+
+            # Bands of the control points matrix: 4 on the diagonal and 1 around it,
+            # with the natural end conditions on the first and last rows
+            diag = 4 * np.ones(n)
+            lower = np.ones(n - 1)
+            upper = np.ones(n - 1)
+            diag[0] = 2
+            diag[n - 1] = 7
+            if n > 1:
+                lower[n - 2] = 2
+            else:
+                # Single segment: straight cubic, the control points at the thirds of the segment
+                diag[0] = 3
+
+            P = 4 * points[:-1] + 2 * points[1:]
+            P[0] = points[0] + 2 * points[1]
+            P[n - 1] = 8 * points[n - 1] + points[n]
+            if n == 1:
+                P[0] = 2 * points[0] + points[1]
+
+            A = self.solve_tridiagonal(lower, diag, upper, P)
+
+            B = np.zeros((n, 3))
+            B[:-1] = 2 * points[1:-1] - A[1:]
+            B[n - 1] = (A[n - 1] + points[n]) / 2
+
+            self.coef = (A, B)
+
+        return self.coef
 
     def get_bezier_cubic(self):
         """
@@ -68,17 +108,60 @@ class Bezier:
         return list_x, list_y, list_z
     
 
+    def get_control_points(self):
+        """
+        Gets the control points of all the segments stacked in a (n_segments, 4, 3) array
+        """
+        points = np.asarray(self.points, dtype=np.float64)
+        A, B = self.get_bezier_coef()
+
+        return np.stack([points[:-1], A, B, points[1:]], axis=1)
+    
+
+    def get_bernstein_basis(self, n):
+        """
+        Gets the cubic Bernstein basis and its first and second derivates 
+        on a grid of n parameters in [0, 1], each one is a (n, 4) matrix.
+        The matrices only depend on n, so they are computed once and shared
+        """
+        if n not in Bezier.basis_cache:
+            t = np.linspace(0, 1, n)[:, None]
+            s = 1 - t
+
+            basis = np.hstack([s**3, 3*s**2*t, 3*s*t**2, t**3])
+            first = np.hstack([-3*s**2, 3*s**2 - 6*s*t, 6*s*t - 3*t**2, 3*t**2])
+            second = np.hstack([6*s, 6*t - 12*s, 6*s - 12*t, 6*t])
+
+            Bezier.basis_cache[n] = (basis, first, second)
+
+        return Bezier.basis_cache[n]
+    
+
+    def evaluate(self, n):
+        """
+        Evaluates all the segments at n parameters in one call
+
+        Returns the positions, first and second derivates, each one 
+        is a (n_segments, n, 3) array
+        """
+        control = self.get_control_points()
+        basis, first, second = self.get_bernstein_basis(n)
+
+        positions = np.einsum('mk,skd->smd', basis, control)
+        derivates = np.einsum('mk,skd->smd', first, control)
+        second_derivates = np.einsum('mk,skd->smd', second, control)
+
+        return positions, derivates, second_derivates
+    
+
     def evaluate_bezier(self, n):
         """
         Evaluate a bezier curve at a point
         """
-        list_x, list_y, list_z = self.get_bezier_cubic()
-        
-        list_x = np.array([fun(t) for fun in list_x for t in np.linspace(0, 1, n)])
-        list_y = np.array([fun(t) for fun in list_y for t in np.linspace(0, 1, n)])
-        list_z = np.array([fun(t) for fun in list_z for t in np.linspace(0, 1, n)])
+        positions, _, _ = self.evaluate(n)
+        positions = positions.reshape(-1, 3)
 
-        return list_x, list_y, list_z
+        return positions[:, 0], positions[:, 1], positions[:, 2]
     
 
     def derivee_bernstein(self, a, b, c, d, t):
@@ -115,55 +198,53 @@ class Bezier:
         return -3*np.power(1-t, 2)*a + 3*np.power(1-t, 2)*b -6*t*(1-t)*b + 3*t*(2-3*t)*c +3*np.power(t, 2)*d
 
    
-    def tangenteAnalytic(self, index):
+    def get_curvatures(self):
         """
-        This function computes the analytical tangente at a given point
-        It evalutes the derivate at x, y and z
+        Curvature of the curve at each point, |d1 x d2| / |d1|^3 with d1 and d2 the first and 
+        second derivatives at the start of each segment, and at the end of the last one
         """
-        points = self.points
+        points = np.asarray(self.points, dtype=np.float64)
         A, B = self.get_bezier_coef()
 
-        if index == len(points)-1:
-            A_index = A[index-1]
-            B_index = B[index-1]
+        first = np.vstack([3 * (A - points[:-1]), 3 * (points[-1] - B[-1])])
+        second = np.vstack([6 * (points[:-1] - 2 * A + B), 6 * (A[-1] - 2 * B[-1] + points[-1])])
 
-            point1 = points[index-1]
-            point2 = points[index]
+        speed = np.linalg.norm(first, axis=1)
+        cross = np.linalg.norm(np.cross(first, second), axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(speed > 0, cross / np.power(speed, 3), 0)
 
-            tan_coord_x = self.get_derivee_cubic(point1[0], A_index[0], B_index[0], point2[0], 1)
-            tan_coord_y = self.get_derivee_cubic(point1[1], A_index[1], B_index[1], point2[1], 1)
-            tan_coord_z = self.get_derivee_cubic(point1[2], A_index[2], B_index[2], point2[2], 1)
 
+    def tangenteAnalytic(self, index):
+        """
+        This function computes the analytical tangente at a given point
+        It evalutes the derivate at x, y and z
+        """
+        points = np.asarray(self.points, dtype=np.float64)
+        A, B = self.get_bezier_coef()
 
-            tangente = np.asarray([tan_coord_x, tan_coord_y, tan_coord_z])
-            tangente = tangente/np.linalg.norm(tangente)
+        if index == len(points)-1:
+            tangente = self.get_derivee_cubic(points[index-1], A[index-1], B[index-1], points[index], 1)
         else:
-            A_index = A[index]
-            B_index = B[index]
-
-            point1 = points[index]
-            point2 = points[index+1]
-
-            tan_coord_x = self.get_derivee_cubic(point1[0], A_index[0], B_index[0], point2[0], 0)
-            tan_coord_y = self.get_derivee_cubic(point1[1], A_index[1], B_index[1], point2[1], 0)
-            tan_coord_z = self.get_derivee_cubic(point1[2], A_index[2], B_index[2], point2[2], 0)
-
-            tangente = np.asarray([tan_coord_x, tan_coord_y, tan_coord_z])
-            tangente = tangente/np.linalg.norm(tangente)
+            tangente = self.get_derivee_cubic(points[index], A[index], B[index], points[index+1], 0)
 
-        return tangente
+        return tangente/np.linalg.norm(tangente)
     
     def get_tangentes(self):
         """
-        Getting the tangentes at a set of points
+        Getting the tangentes at a set of points, the derivate is evaluated at t=0 
+        of each segment and at t=1 of the last one
         """        
+        points = np.asarray(self.points, dtype=np.float64)
+        A, B = self.get_bezier_coef()
 
-        points = self.points
-        tangentes = []
-        for i in range(len(points)):
-            tangente = self.tangenteAnalytic(i)
-            tangentes.append(tangente)
-        return tangentes
+        # Derivate at t=0: 3(A - P0), at t=1: 3(P1 - B)
+        tangentes = np.zeros(points.shape)
+        tangentes[:-1] = 3 * (A - points[:-1])
+        tangentes[-1] = 3 * (points[-1] - B[-1])
+        tangentes = tangentes/np.linalg.norm(tangentes, axis=1)[:, None]
+
+        return list(tangentes)
     
 
     def AreCollinear(self, vector1, vector2):
@@ -206,9 +287,13 @@ class Bezier:
     def get_normals(self, tangentes):
         """
         Getting the normals, given a set of tangents, 
-        we generate a set of non collinear vectors and 
-        apply the cross product
+        in "random" mode we generate a set of non collinear vectors and 
+        apply the cross product, in "rmf" mode see BezierBatch.get_rotation_minimizing_normals
         """
+        if self.frame_mode == "rmf":
+            batch = BezierBatch(self.points, [0, len(self.points)])
+            return list(batch.get_rotation_minimizing_normals(np.asarray(tangentes)))
+
         non_collinaire = self.get_non_collinaire_vector(tangentes[0])
 
         normals = []
@@ -226,15 +311,238 @@ class Bezier:
         Getting the binormals, given the tangents and the normals 
         We apply the cross product
         """
-        binormals = []
-
         if len(tangentes) != len(normals):
             print("Error: Index out of range, tangentes and Normals sizes are not equal")
             return
         else: 
-            for i in range(len(tangentes)):
-                binormal = np.cross(tangentes[i], normals[i])
-                binormal = binormal/np.linalg.norm(binormal)
-                binormals.append(binormal)
+            binormals = np.cross(tangentes, normals)
+            binormals = binormals/np.linalg.norm(binormals, axis=1)[:, None]
+
+            return list(binormals)
+
+
+class BezierBatch: 
+    """
+    This class fits a Bezier Cubic curve on every branch of a vessel tree at once,
+    all the tridiagonal systems are solved together and the tangentes, normals 
+    and binormals are computed for all the points in a single vectorized pass
+    :points : concatenated points of all the branches, shape (P, 3)
+    :offsets : start of each branch in points followed by P, shape (n_branches + 1,)
+    :frame_mode : "rmf" or "random", see Bezier
+    """
+
+    def __init__(self, points, offsets, frame_mode="rmf"):
+        # Initializer
+        self.points = np.asarray(points, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.frame_mode = frame_mode
+        self.coef = None
+
+        # Number of points and of segments per branch, and start of each branch in the segments
+        self.lengths = np.diff(self.offsets)
+        self.segments = self.lengths - 1
+        self.segment_offsets = self.offsets - np.arange(len(self.offsets))
+
+        if np.any(self.lengths < 2):
+            print("Error: every branch needs at least two points to fit a Bezier curve")
+
+        # Branch index and position in its branch of every point
+        self.branch_of_point = np.repeat(np.arange(len(self.lengths)), self.lengths)
+        self.index_in_branch = np.arange(len(self.points)) - self.offsets[self.branch_of_point]
+
+    @classmethod
+    def from_branches(cls, branches, frame_mode="rmf"):
+        """
+        Builds the batch from a list of branches, each one a list of points
+        """
+        branches = [np.asarray(branch, dtype=np.float64).reshape(-1, 3) for branch in branches]
+        offsets = np.zeros(len(branches) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(branch) for branch in branches])
+
+        return cls(np.concatenate(branches), offsets, frame_mode)
+
+    def split(self, values):
+        """
+        Splits a per point array into a list of per branch arrays
+        """
+        return np.split(values, self.offsets[1:-1])
+
+    @staticmethod
+    def solve_ragged_tridiagonal(lower, diag, upper, rhs, starts, sizes):
+        """
+        Solves the tridiagonal systems of all the branches at once with the Thomas algorithm, 
+        the systems are stored one after the other, without padding
+
+        :lower : coefficient of the previous unknown in each row, 0 in the first row of a system, shape (S,)
+        :diag : main diagonal, shape (S,)
+        :upper : coefficient of the next unknown in each row, 0 in the last row of a system, shape (S,)
+        :rhs : right hand side, shape (S, 3)
+        :starts : first row of each system, shape (n_systems,)
+        :sizes : number of rows of each system, shape (n_systems,)
+
+        Row i of all the systems longer than i is handled at each step, the systems are sorted 
+        by decreasing size so that they are the first ones of the order
+        """
+        order = np.argsort(-sizes, kind="stable")
+        decreasing = -sizes[order]
+        c = np.zeros(diag.shape)
+        d = np.zeros(rhs.shape)
+
+        c[starts] = upper[starts] / diag[starts]
+        d[starts] = rhs[starts] / diag[starts][:, None]
+        for i in range(1, int(sizes.max())):
+            row = starts[order[:np.searchsorted(decreasing, -i)]] + i
+            denom = diag[row] - lower[row] * c[row - 1]
+            c[row] = upper[row] / denom
+            d[row] = (rhs[row] - lower[row][:, None] * d[row - 1]) / denom[:, None]
+
+        for i in range(int(sizes.max()) - 2, -1, -1):
+            row = starts[order[:np.searchsorted(decreasing, -(i + 1))]] + i
+            d[row] = d[row] - c[row][:, None] * d[row + 1]
+
+        return d
+
+    def get_bezier_coef(self):
+        """
+        Gets the Control points coefficients of all the branches, one row per segment: 
+        A and B have a shape (S, 3), the segments of a branch start at segment_offsets
+        """
+        if self.coef is None:
+            n = self.segments
+            starts = self.segment_offsets[:-1]
+
+            # Branch and position in its branch of every segment, and its two points
+            branch = np.repeat(np.arange(len(n)), n)
+            k = np.arange(len(branch)) - starts[branch]
+            points = self.points[self.offsets[branch] + k]
+            points_next = self.points[self.offsets[branch] + k + 1]
+            first = k == 0
+            last = k == n[branch] - 1
+
+            # Bands of every system, with the natural end conditions on the first and last rows, 
+            # a single segment is a straight cubic, its control points at the thirds of the segment
+            diag = np.where(first & last, 3.0, np.where(first, 2.0, np.where(last, 7.0, 4.0)))
+            lower = np.where(first, 0.0, np.where(last, 2.0, 1.0))
+            upper = np.where(last, 0.0, 1.0)
+
+            P = 4 * points + 2 * points_next
+            P[first] = points[first] + 2 * points_next[first]
+            P[last] = 8 * points[last] + points_next[last]
+            P[first & last] = 2 * points[first & last] + points_next[first & last]
+
+            A = self.solve_ragged_tridiagonal(lower, diag, upper, P, starts, n)
+
+            B = np.empty(A.shape)
+            inner = np.flatnonzero(~last)
+            B[inner] = 2 * points_next[inner] - A[inner + 1]
+            B[last] = (A[last] + points_next[last]) / 2
+
+            self.coef = (A, B)
+
+        return self.coef
+
+    def get_tangentes(self):
+        """
+        Getting the tangentes at all the points, shape (P, 3)
+        """
+        A, B = self.get_bezier_coef()
+        branch = self.branch_of_point
+        index = self.index_in_branch
+        last = index == self.segments[branch]
+
+        # Derivate at t=0 of each segment, and at t=1 of the last one
+        segment = self.segment_offsets[branch] + index
+        tangentes = np.empty(self.points.shape)
+        first = ~last
+        tangentes[first] = 3 * (A[segment[first]] - self.points[first])
+        tangentes[last] = 3 * (self.points[last] - B[segment[last] - 1])
+
+        return tangentes/np.linalg.norm(tangentes, axis=1)[:, None]
+
+    def get_rotation_minimizing_normals(self, tangentes):
+        """
+        Getting the normals of rotation minimizing frames with the double reflection 
+        method (Wang et al. 2008). The first normal of a branch is built from the axis 
+        the least aligned with its first tangente, then each normal is reflected along 
+        the branch, so identical inputs always give identical frames. 
+        The loop runs along the longest branch, all the branches are handled at each step
+        """
+        points = self.points
+        starts = self.offsets[:-1]
+        normals = np.zeros(points.shape)
+
+        # First normal: the least aligned axis, made orthogonal to the first tangente
+        first = tangentes[starts]
+        axis = np.eye(3)[np.argmin(np.abs(first), axis=1)]
+        normal = axis - np.sum(axis * first, axis=1)[:, None] * first
+        normal = normal/np.linalg.norm(normal, axis=1)[:, None]
+        normals[starts] = normal
+
+        for k in range(int(self.lengths.max()) - 1):
+            active = np.flatnonzero(k + 1 < self.lengths)
+            current = starts[active] + k
+            normal = normals[current]
+            tangente = tangentes[current]
+            next_tangente = tangentes[current + 1]
+
+            # First reflection, on the plane bisecting the two points
+            v1 = points[current + 1] - points[current]
+            c1 = np.sum(v1 * v1, axis=1)
+            c1 = np.where(c1 > 0, c1, np.inf)[:, None]
+            normal_left = normal - 2 / c1 * np.sum(v1 * normal, axis=1)[:, None] * v1
+            tangente_left = tangente - 2 / c1 * np.sum(v1 * tangente, axis=1)[:, None] * v1
+
+            # Second reflection, bringing the reflected tangente on the next tangente
+            v2 = next_tangente - tangente_left
+            c2 = np.sum(v2 * v2, axis=1)
+            c2 = np.where(c2 > 1e-30, c2, np.inf)[:, None]
+            normal = normal_left - 2 / c2 * np.sum(v2 * normal_left, axis=1)[:, None] * v2
+
+            # Removing the numerical drift
+            normal = normal - np.sum(normal * next_tangente, axis=1)[:, None] * next_tangente
+            normals[current + 1] = normal/np.linalg.norm(normal, axis=1)[:, None]
+
+        return normals
+
+    def get_normals(self, tangentes):
+        """
+        Getting the normals, rotation minimizing in "rmf" mode. In "random" mode 
+        one non collinear vector is generated per branch and crossed with all 
+        the tangentes of the branch
+        """
+        if self.frame_mode == "rmf":
+            return self.get_rotation_minimizing_normals(tangentes)
+
+        first_tangentes = tangentes[self.offsets[:-1]]
+        non_collinaire = np.zeros(first_tangentes.shape)
+
+        # Drawing random vectors until none of them is collinear to its first tangente
+        todo = np.arange(len(first_tangentes))
+        while len(todo): 
+            vect = np.random.random((len(todo), 3))
+            vect = vect/np.linalg.norm(vect, axis=1)[:, None]
+            cross = np.cross(first_tangentes[todo], vect)
+            found = np.abs(cross.sum(axis=1)) >= 1e-10
+            non_collinaire[todo[found]] = cross[found]
+            todo = todo[~found]
+
+        normals = np.cross(tangentes, non_collinaire[self.branch_of_point])
+        return normals/np.linalg.norm(normals, axis=1)[:, None]
+
+    def get_binormals(self, tangentes, normals):
+        """
+        Getting the binormals, given the tangents and the normals 
+        """
+        binormals = np.cross(tangentes, normals)
+        return binormals/np.linalg.norm(binormals, axis=1)[:, None]
+
+    def get_frames(self):
+        """
+        Getting the tangentes, normals and binormals of every branch, 
+        as three lists of per branch (n_points, 3) arrays
+        """
+        tangentes = self.get_tangentes()
+        normals = self.get_normals(tangentes)
+        binormals = self.get_binormals(tangentes, normals)
 
-            return binormals
\ No newline at end of file
+        return self.split(tangentes), self.split(normals), self.split(binormals)
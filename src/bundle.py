@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from beam import Beam
+from skeleton_cache import write_atomic
+from vessel import PREPROCESSING_VERSION
+
+
+# Version of the bundle layout, a bundle of another version is never loaded
+BUNDLE_VERSION = 1
+
+
+class BundleBeam: 
+    """
+    Precompiled beam read from a bundle, it has the same accessors as Beam for the
+    scene building, but nothing is sampled nor fitted: the poses are stored
+    :rigid : positions + quaternions of the beam nodes, shape (N, 7)
+    :edges : edges of the beam, shape (N-1, 2)
+    """
+    __slots__ = ('rigid', 'topology', 'sample', 'vertices', 'num_nodes', 'frames')
+
+    #Initializer
+    def __init__(self, rigid, edges): 
+        self.rigid = rigid
+        self.topology = edges
+        # Contiguous copy of the positions, the MechanicalObjects get the same kind of array as from a live graph
+        self.sample = np.ascontiguousarray(rigid[:, :3])
+        self.vertices = self.get_vertices()
+        self.num_nodes = len(rigid)
+
+        # Frames are already baked in the quaternions
+        self.frames = ()
+
+
+    to_string = Beam.to_string
+
+
+    def get_topology(self, as_string=False): 
+        """
+        Getting the stored edges of the beam
+        """
+        if as_string: 
+            return self.to_string(self.topology)
+        return self.topology
+
+
+    def get_MO_rigid(self, frames=None, as_string=False): 
+        """
+        Getting the stored positions + quaternions of the beam
+        """
+        if as_string: 
+            return self.to_string(self.rigid)
+        return self.rigid
+
+
+    def get_MO_vec(self, as_string=False): 
+        """
+        Getting the stored positions of the beam
+        """
+        if as_string: 
+            return self.to_string(self.sample)
+        return self.sample
+
+
+    def get_vertices(self): 
+        """
+        Get the coordonates of the beam vertices
+        """
+        return  [self.sample[0], self.sample[-1]]
+
+
+
+class VesselBundle: 
+    """
+    Fully preprocessed vessel model, stored in one versioned ".npz" file. It has the same
+    accessors as VGraph for the scene building (graph, get_beam, get_frames, get_fixed_indices,
+    get_bifurcations, get_tree), so a known patient is loaded without parsing, sampling nor fitting
+
+    Bundle content:
+
+        metadata = json: version, preprocessing version, settings, sampling rate and graph, the graph keys give the beam order
+
+        rigid, rigid_offsets = ragged (P, 7) poses of all the beams
+
+        edges, edges_offsets = ragged (E, 2) edges of all the beams, in beam node indices
+
+        fixed, fixed_offsets = ragged fixed node indices of all the beams
+
+        bifurcations = (K, 5) rows of source branch, source extremity, target branch, source node, target node
+
+        tree_rigid, tree_edges, tree_nodes, tree_fixed = monolithic tree, see VGraph.get_tree
+    """
+    def __init__(self, metadata, arrays): 
+        self.metadata = metadata
+        self.settings = metadata['settings']
+        self.sampling_rate = metadata['sampling_rate']
+        self.graph = metadata['graph']
+        self.arrays = arrays
+
+        keys = [int(key) for key in self.graph]
+        rigid = self.split(arrays['rigid'], arrays['rigid_offsets'])
+        edges = self.split(arrays['edges'], arrays['edges_offsets'])
+        fixed = self.split(arrays['fixed'], arrays['fixed_offsets'])
+
+        # Beam registry, as in VGraph: {(branch index, sampling rate): beam}
+        self.beams = {(index, self.sampling_rate): BundleBeam(rigid[i], edges[i]) for i, index in enumerate(keys)}
+        self.fixed = {index: fixed[i].tolist() for i, index in enumerate(keys)}
+        self.bifurcations = {(int(row[0]), int(row[1]), int(row[2])): (int(row[3]), int(row[4])) for row in arrays['bifurcations']}
+
+
+    @staticmethod
+    def split(values, offsets): 
+        """
+        Splits a ragged array into the list of its parts
+        """
+        return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+    @staticmethod
+    def get_offsets(parts): 
+        """
+        Offsets of a list of parts in their concatenation, starting with 0
+        """
+        return np.concatenate([[0], np.cumsum([len(part) for part in parts])]).astype(np.int64)
+
+
+    @staticmethod
+    def get_digest(filename): 
+        """
+        Hash of the file bytes, used to know if the skeleton of a bundle changed
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file: 
+            for chunk in iter(lambda: file.read(1 << 20), b''): 
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    @classmethod
+    def from_graph(cls, vessel, settings, sampling_rate=None): 
+        """
+        Preprocesses all the beams of a VGraph and builds the bundle
+
+        :vessel : VGraph of the vessel tree
+        :settings : dictionnary of the settings the bundle was built with, see is_valid
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        if sampling_rate is None: 
+            sampling_rate = vessel.sampling_rate
+
+        # Bezier curve fitting of all the branches at once
+        frames = vessel.get_frames(sampling_rate)
+
+        rigid = []
+        edges = []
+        fixed = []
+        for key, frame in zip(vessel.graph, frames): 
+            beam = vessel.get_beam(int(key), sampling_rate)
+            rigid.append(beam.get_MO_rigid(frame))
+            edges.append(beam.get_topology())
+            fixed.append(np.asarray(vessel.get_fixed_indices(int(key), sampling_rate), dtype=np.int64))
+
+        bifurcations = [list(key) + list(value) for key, value in vessel.get_bifurcations(sampling_rate).items()]
+        tree_rigid, tree_edges, tree_nodes, tree_fixed = vessel.get_tree(sampling_rate)
+
+        arrays = {
+            'rigid': np.concatenate(rigid),
+            'rigid_offsets': cls.get_offsets(rigid),
+            'edges': np.concatenate(edges),
+            'edges_offsets': cls.get_offsets(edges),
+            'fixed': np.concatenate(fixed),
+            'fixed_offsets': cls.get_offsets(fixed),
+            'bifurcations': np.asarray(bifurcations, dtype=np.int64).reshape(-1, 5),
+            'tree_rigid': tree_rigid,
+            'tree_edges': tree_edges,
+            'tree_nodes': np.concatenate(tree_nodes),
+            'tree_nodes_offsets': cls.get_offsets(tree_nodes),
+            'tree_fixed': np.asarray(tree_fixed, dtype=np.int64),
+        }
+        metadata = {
+            'version': BUNDLE_VERSION,
+            'preprocessing': PREPROCESSING_VERSION,
+            'settings': settings,
+            'sampling_rate': sampling_rate,
+            'graph': vessel.graph,
+        }
+        return cls(metadata, arrays)
+
+
+    def save(self, filename): 
+        """
+        Writes the bundle in one ".npz" file, the metadata is stored as a json string
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+        # np.savez appends ".npz" to a file name without it
+        write_atomic(filename, lambda temporary: np.savez(temporary, metadata=np.array(json.dumps(self.metadata)), **self.arrays), ".npz")
+
+
+    @classmethod
+    def load(cls, filename): 
+        """
+        Reads a bundle, returns None if the file is missing or of another version
+        """
+        if not os.path.exists(filename): 
+            return None
+
+        with np.load(filename, allow_pickle=False) as data: 
+            metadata = json.loads(str(data['metadata']))
+            if metadata.get('version') != BUNDLE_VERSION: 
+                print("Error: bundle version ", metadata.get('version'), " is not ", BUNDLE_VERSION, ", it will be rebuilt")
+                return None
+            arrays = {name: data[name] for name in data.files if name != 'metadata'}
+
+        return cls(metadata, arrays)
+
+
+    def is_valid(self, settings): 
+        """
+        Tests if the bundle was built with the given settings and by the current preprocessing code
+        """
+        if self.metadata.get('preprocessing') != PREPROCESSING_VERSION: 
+            print("Bundle built by the preprocessing version ", self.metadata.get('preprocessing'), ", not ", PREPROCESSING_VERSION, ", it will be rebuilt")
+            return False
+        return json.dumps(self.settings, sort_keys=True) == json.dumps(settings, sort_keys=True)
+
+
+    def get_beam(self, index, sampling_rate=None): 
+        """
+        Gets the precompiled beam of a branch
+        """
+        if sampling_rate is None: 
+            sampling_rate = self.sampling_rate
+        if (index, sampling_rate) not in self.beams: 
+            print("Error: the bundle has no beam ", index, " at the sampling rate ", sampling_rate)
+            return None
+        return self.beams[(index, sampling_rate)]
+
+
+    def get_frames(self, sampling_rate=None): 
+        """
+        Nothing to fit, the frames are already baked in the stored quaternions
+        """
+        return [self.get_beam(int(key), sampling_rate).frames for key in self.graph]
+
+
+    def get_fixed_indices(self, index, sampling_rate=None): 
+        """
+        Gets the stored node indices of the free extremities of a beam
+        """
+        return self.fixed[index]
+
+
+    def get_bifurcations(self, sampling_rate=None): 
+        """
+        Gets the stored node indices coupled at each bifurcation
+        """
+        return self.bifurcations
+
+
+    def get_tree(self, sampling_rate=None): 
+        """
+        Gets the stored monolithic tree: rigid, edges, nodes, fixed
+        """
+        arrays = self.arrays
+        nodes = self.split(arrays['tree_nodes'], arrays['tree_nodes_offsets'])
+        return arrays['tree_rigid'], arrays['tree_edges'], nodes, arrays['tree_fixed'].tolist()
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+
+
+# Degrees of freedom of a node of a MechanicalObject, by template: a rigid has 3 translations and 3 rotations
+DOFS_PER_NODE = {'Rigid3d': 6, 'Rigid3f': 6, 'Rigid3': 6, 'Vec3d': 3, 'Vec3f': 3, 'Vec3': 3, 'Vec2d': 2, 'Vec1d': 1}
+
+
+class HeadlessRunner:
+    """
+    Builds a scene and simulates it without GUI, recording the wall and CPU time of each step
+    :createScene : function adding the scene to a root node, as the createScene of a Sofa scene file
+    :plugins : plugins imported with SofaRuntime before the scene is built
+    """
+    def __init__(self, createScene, plugins=()):
+        self.createScene = createScene
+        self.plugins = plugins
+        self.root = None
+        self.report = None
+
+
+    def build(self):
+        """
+        Builds and initializes the scene, returns the root node
+        """
+        import Sofa.Core
+        import Sofa.Simulation
+        import SofaRuntime
+
+        for plugin in self.plugins:
+            SofaRuntime.importPlugin(plugin)
+
+        start = time.perf_counter()
+        self.root = Sofa.Core.Node("root")
+        self.createScene(self.root)
+        Sofa.Simulation.init(self.root)
+        self.build_time = time.perf_counter() - start
+
+        return self.root
+
+
+    def run(self, steps, dt=None):
+        """
+        Simulates steps time steps, returns the report
+
+        :steps : number of time steps
+        :dt : time step, the one of the root node by default
+        """
+        import Sofa.Simulation
+
+        if self.root is None:
+            self.build()
+        if dt is None:
+            dt = self.root.dt.value
+
+        wall_times = []
+        cpu_times = []
+        for _ in range(steps):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            Sofa.Simulation.animate(self.root, dt)
+            cpu_times.append(time.process_time() - cpu)
+            wall_times.append(time.perf_counter() - wall)
+
+        total = sum(wall_times)
+        self.report = {
+            'steps': steps,
+            'dt': dt,
+            'build_time': self.build_time,
+            'wall_time': total,
+            'cpu_time': sum(cpu_times),
+            'steps_per_second': steps / total if total > 0 else None,
+            'mean_step_time': total / steps if steps else None,
+            'max_step_time': max(wall_times) if steps else None,
+            'step_wall_times': wall_times,
+            'step_cpu_times': cpu_times,
+            'dofs': self.get_dofs(self.root),
+        }
+        return self.report
+
+
+    def get_dofs(self, root):
+        """
+        Counts the degrees of freedom of the MechanicalObjects of the scene. The mapped ones,
+        in a node holding a mapping, follow other MechanicalObjects and are not solved for
+
+        Returns the total and independent counts, and the count of each MechanicalObject
+        """
+        mechanical_objects = []
+        seen = set()
+        todo = [root]
+        while todo:
+            node = todo.pop()
+            path = node.getPathName()
+            if path in seen:
+                continue
+            seen.add(path)
+            todo.extend(node.children)
+
+            mapped = any(component.getClassName().endswith('Mapping') for component in node.objects)
+            for component in node.objects:
+                if component.getClassName() != 'MechanicalObject':
+                    continue
+                template = component.getTemplateName()
+                number_of_nodes = len(component.position.value)
+                mechanical_objects.append({
+                    'path': path + "/" + component.getName(),
+                    'template': template,
+                    'nodes': number_of_nodes,
+                    'dofs': number_of_nodes * DOFS_PER_NODE.get(template, 3),
+                    'mapped': mapped,
+                })
+
+        return {
+            'total': sum(mo['dofs'] for mo in mechanical_objects),
+            'independent': sum(mo['dofs'] for mo in mechanical_objects if not mo['mapped']),
+            'mechanical_objects': mechanical_objects,
+        }
+
+
+    def save(self, filename):
+        """
+        Writes the report as json
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, 'w') as file:
+            json.dump(self.report, file, indent=4)
+
+
+    def summary(self):
+        """
+        One line summary of the run
+        """
+        report = self.report
+        return "{} steps in {:.3f} s: {:.2f} steps/s, {:.4f} s per step (max {:.4f} s), {} dofs ({} independent), scene built in {:.3f} s".format(
+            report['steps'], report['wall_time'], report['steps_per_second'] or 0, report['mean_step_time'] or 0, report['max_step_time'] or 0,
+            report['dofs']['total'], report['dofs']['independent'], report['build_time'])
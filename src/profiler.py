@@ -0,0 +1,138 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    """
+    Records, for each stage of the scene building, its wall time, CPU time, peak traced memory
+    and the number of Sofa nodes and components it created. Stages can be nested,
+    a stage opened inside another one is its child in the report
+    :memory : traces the memory with tracemalloc, it slows the Python code down
+    """
+    def __init__(self, memory=True):
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        # Finished stages, in the order they were opened
+        self.stages = []
+
+        # Stages being run, innermost last
+        self.stack = []
+
+
+    @contextmanager
+    def stage(self, name, node=None):
+        """
+        Runs a stage, used as "with profiler.stage(name, node):"
+
+        :name : name of the stage
+        :node : Sofa node whose nodes and components are counted before and after the stage
+        """
+        record = {'name': name, 'depth': len(self.stack), 'parent': self.stack[-1]['name'] if self.stack else None}
+        self.stages.append(record)
+
+        nodes, components = self.count(node)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], peak)
+            tracemalloc.reset_peak()
+            record['memory_start'] = current
+            record['peak_memory'] = current
+        self.stack.append(record)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = time.process_time() - cpu
+
+            self.stack.pop()
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                record['peak_memory'] = max(record['peak_memory'], peak)
+                record['allocated_memory'] = current - record['memory_start']
+                if self.stack:
+                    self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], record['peak_memory'])
+
+            if node is not None:
+                after_nodes, after_components = self.count(node)
+                record['nodes'] = after_nodes - nodes
+                record['components'] = after_components - components
+
+
+    def count(self, node):
+        """
+        Counts the nodes and the components of a Sofa graph, a node with several parents is counted once
+        """
+        if node is None:
+            return 0, 0
+
+        seen = set()
+        nodes = 0
+        components = 0
+        todo = [node]
+        while todo:
+            current = todo.pop()
+            key = current.getPathName() if hasattr(current, 'getPathName') else id(current)
+            if key in seen:
+                continue
+            seen.add(key)
+            nodes += 1
+            components += len(current.objects)
+            todo.extend(current.children)
+
+        return nodes, components
+
+
+    def get_report(self):
+        """
+        Structured report: the stages in the order they were opened, and the totals of the outer stages
+        """
+        outer = [stage for stage in self.stages if stage['depth'] == 0]
+        total = {
+            'wall_time': sum(stage.get('wall_time', 0) for stage in outer),
+            'cpu_time': sum(stage.get('cpu_time', 0) for stage in outer),
+            'nodes': sum(stage.get('nodes', 0) for stage in outer),
+            'components': sum(stage.get('components', 0) for stage in outer),
+        }
+        if self.memory:
+            total['peak_memory'] = max([stage.get('peak_memory', 0) for stage in outer] + [0])
+
+        return {'stages': self.stages, 'total': total}
+
+
+    def save(self, filename):
+        """
+        Writes the report as json
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w') as file:
+            json.dump(self.get_report(), file, indent=4)
+
+
+    def summary(self, width=40):
+        """
+        Flame style summary: one line per stage, indented by depth, with a bar of its share of the total wall time
+        """
+        total = self.get_report()['total']['wall_time'] or 1
+        lines = []
+        for stage in self.stages:
+            wall_time = stage.get('wall_time', 0)
+            bar = "#" * int(round(width * wall_time / total))
+            line = "{:<36} {:9.4f} s {:9.4f} s cpu {:5.1f}% {:<{width}}".format("  " * stage['depth'] + stage['name'], wall_time, stage.get('cpu_time', 0), 100 * wall_time / total, bar, width=width)
+            if 'peak_memory' in stage:
+                line += " {:9.2f} MB".format(stage['peak_memory'] / 1e6)
+            if 'nodes' in stage:
+                line += " {:5d} nodes {:6d} components".format(stage['nodes'], stage['components'])
+            lines.append(line)
+
+        return "\n".join(lines)
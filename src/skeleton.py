@@ -0,0 +1,140 @@
+"""
+Centerlines file formats
+
+    Text: one point "x y z" per line, branches separated by a blank line (output of the CGAL skeletonization)
+
+    Binary: "name.npy" holds the float64 (P, 3) points of all the branches, 
+            "name.offsets.npy" the int64 (N + 1,) start of each branch in the points followed by P. 
+            Both are plain .npy files, loaded memory mapped: branches are zero-copy views
+"""
+import os
+import re
+import sys
+from itertools import islice
+
+import numpy as np
+
+
+def get_offsets_file(filename):
+    """
+    Offsets file of a binary skeleton
+    """
+    return os.path.splitext(filename)[0] + ".offsets.npy"
+
+
+def read_text_skeleton(filename):
+    """
+    Reads a text skeleton in bulk, the last branch is kept even without a final blank line
+
+    Returns the (P, 3) points and (N + 1,) offsets arrays
+    """
+    with open(filename) as file: 
+        text = file.read().strip()
+
+    # Blocks of consecutive non blank lines are the branches
+    blocks = re.split(r'\n(?:[ \t\r]*\n)+', text) if text else []
+    lengths = [block.count('\n') + 1 for block in blocks]
+
+    points = np.array(text.split(), dtype=np.float64).reshape(-1, 3)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    if offsets[-1] != len(points): 
+        print("Error: each line of the skeleton should hold 3 coordinates ", filename)
+
+    return points, offsets
+
+
+def write_binary_skeleton(filename, points, offsets):
+    """
+    Writes the points and offsets of a skeleton as a binary skeleton
+    """
+    np.save(filename, np.ascontiguousarray(points, dtype=np.float64))
+    np.save(get_offsets_file(filename), np.ascontiguousarray(offsets, dtype=np.int64))
+
+
+def read_binary_skeleton(filename, mmap_mode='r'):
+    """
+    Reads a binary skeleton, memory mapped by default
+
+    Returns the (P, 3) points and (N + 1,) offsets arrays
+    """
+    points = np.load(filename, mmap_mode=mmap_mode)
+    offsets = np.load(get_offsets_file(filename))
+
+    return points, offsets
+
+
+def convert_skeleton(text_file, binary_file=None):
+    """
+    Converts a text skeleton to a binary one, "name.txt" gives "name.npy" by default
+
+    Returns the binary skeleton file name
+    """
+    if binary_file is None: 
+        binary_file = os.path.splitext(text_file)[0] + ".npy"
+    points, offsets = read_text_skeleton(text_file)
+    write_binary_skeleton(binary_file, points, offsets)
+
+    return binary_file
+
+
+def iter_text_skeleton(filename, chunk_lines=65536):
+    """
+    Reads a text skeleton one branch at a time, each branch is yielded as a (n, 3) array. 
+    Lines are read and parsed by chunks, so the memory used while reading is bounded by 
+    the chunk and the largest branch, not by the whole file
+
+    :chunk_lines : number of lines read and parsed at once
+    """
+    pieces = []
+    with open(filename) as file: 
+        while True: 
+            lines = list(islice(file, chunk_lines))
+            if not lines: 
+                break
+
+            # Blank lines close the current branch
+            blanks = [i for i, line in enumerate(lines) if not line.strip()]
+            start = 0
+            for end in blanks + [len(lines)]: 
+                if end > start: 
+                    pieces.append(np.array("".join(lines[start:end]).split(), dtype=np.float64).reshape(-1, 3))
+                if end < len(lines) and pieces: 
+                    yield np.concatenate(pieces)
+                    pieces = []
+                start = end + 1
+
+    # Last branch, without a final blank line
+    if pieces: 
+        yield np.concatenate(pieces)
+
+
+def iter_binary_skeleton(filename):
+    """
+    Reads a binary skeleton one branch at a time, each branch is a memory mapped view
+    """
+    points, offsets = read_binary_skeleton(filename)
+    for i in range(len(offsets) - 1): 
+        yield points[offsets[i]:offsets[i + 1]]
+
+
+def iter_skeleton(filename, chunk_lines=65536):
+    """
+    Reads a text or binary ".npy" skeleton one branch at a time
+    """
+    if filename.endswith('.npy'): 
+        return iter_binary_skeleton(filename)
+    return iter_text_skeleton(filename, chunk_lines)
+
+
+def split_branches(points, offsets):
+    """
+    List of the branches as views on the points, without copies
+    """
+    return [points[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+if __name__ == '__main__':
+    # python src/skeleton.py data/skeleton/output_skeleton.txt [output.npy]
+    print(convert_skeleton(*sys.argv[1:3]))
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import shutil
+
+
+def write_atomic(filename, write, suffix=""): 
+    """
+    Writes a file aside then renames it, so a concurrent reader never sees a partial file
+
+    :write : function writing the content in the path it is given
+    :suffix : end of the temporary file name, e.g. the extension a writer appends when it is missing
+    """
+    temporary = filename + ".tmp" + str(os.getpid()) + suffix
+    write(temporary)
+    os.replace(temporary, filename)
+
+
+class SkeletonCache: 
+    """
+    Content addressed cache of the centerlines computed by the CGAL skeletonization. 
+    A skeleton is stored under the hash of the mesh file bytes and of the skeletonization 
+    settings, so a mesh that did not change is never skeletonized twice
+    :directory : folder of the cached skeletons, created if needed
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.stats_file = os.path.join(directory, "stats.json")
+
+        # Hits and misses of this cache object
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, mesh, settings):
+        """
+        Hash of the mesh file bytes and of the skeletonization settings
+
+        :mesh : mesh file path 
+        :settings : dictionnary of the settings used by the skeletonization
+        """
+        digest = hashlib.sha256()
+        with open(mesh, 'rb') as file: 
+            for chunk in iter(lambda: file.read(1 << 20), b''): 
+                digest.update(chunk)
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        """
+        Path of the cached skeleton of a key
+        """
+        return os.path.join(self.directory, key + ".txt")
+
+    def load(self, key, outputfile):
+        """
+        Copies the cached skeleton of a key to the output file, returns False on a miss
+        """
+        path = self.get_path(key)
+        if not os.path.exists(path): 
+            self.misses += 1
+            self.save_stats(misses=1)
+            return False
+
+        if os.path.abspath(path) != os.path.abspath(outputfile): 
+            shutil.copyfile(path, outputfile)
+        self.hits += 1
+        self.save_stats(hits=1)
+        return True
+
+    def store(self, key, outputfile):
+        """
+        Stores the skeleton written in the output file under a key
+        """
+        if not os.path.exists(outputfile): 
+            print("Error: no skeleton to cache in ", outputfile)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+        write_atomic(self.get_path(key), lambda temporary: shutil.copyfile(outputfile, temporary))
+
+    def get_stats(self):
+        """
+        Cumulative hits and misses of all the runs using this directory
+        """
+        if not os.path.exists(self.stats_file): 
+            return {'hits': 0, 'misses': 0}
+        with open(self.stats_file) as file: 
+            return json.load(file)
+
+    def save_stats(self, hits=0, misses=0):
+        """
+        Adds hits and misses to the cumulative counts
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        stats = self.get_stats()
+        stats['hits'] += hits
+        stats['misses'] += misses
+        with open(self.stats_file, 'w') as file: 
+            json.dump(stats, file)
+
+    def report(self):
+        """
+        Hits and misses of this run and of all the runs
+        """
+        stats = self.get_stats()
+        return {'hits': self.hits, 'misses': self.misses, 'total_hits': stats['hits'], 'total_misses': stats['misses']}
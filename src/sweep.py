@@ -0,0 +1,232 @@
+"""
+Parameter sweep over the digitaltwin dictionnary, each variant is simulated in its own headless process
+
+    python3 src/sweep.py grid.json --steps 100 --workers 4 --output ./data/sweep
+
+grid.json maps dotted parameter names to lists of values, every combination is a variant:
+
+    {"parenchyma.young_modulus": [5000, 6500, 8000], "vessels.sampling_rate": [0.004, 0.005]}
+"""
+import argparse
+import copy
+import csv
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Parameters the preprocessed vessel model depends on, variants sharing them share the vessel bundle
+GEOMETRY_PARAMETERS = ['vessels.skeleton_output', 'vessels.sampling_rate', 'vessels.sampling_mode',
+                       'vessels.adjacency_tolerance', 'vessels.frame_mode', 'vessels.adaptive_sampling']
+
+
+def get_parameter(parameters, name):
+    """
+    Gets a parameter of nested dictionnaries from its dotted name, e.g. "vessels.sampling_rate",
+    raises a KeyError when it does not exist
+    """
+    for key in name.split('.'):
+        if not isinstance(parameters, dict) or key not in parameters:
+            raise KeyError("unknown parameter " + name)
+        parameters = parameters[key]
+    return parameters
+
+
+def set_parameter(parameters, name, value):
+    """
+    Sets a parameter of nested dictionnaries from its dotted name, e.g. "vessels.sampling_rate",
+    raises a KeyError when it does not exist, so a typo never runs the base parameters
+    """
+    keys = name.split('.')
+    get_parameter(parameters, name)
+    for key in keys[:-1]:
+        parameters = parameters[key]
+    parameters[keys[-1]] = value
+
+
+def set_parameters(parameters, overrides):
+    """
+    Sets all the parameters of a {dotted name: value} dictionnary
+    """
+    for name, value in overrides.items():
+        set_parameter(parameters, name, value)
+    return parameters
+
+
+class ParameterSweep:
+    """
+    Runs every variant of a parameter grid as a headless DigitalTwin.py process, in a pool of workers
+    :parameters : base digitaltwin dictionnary
+    :grid : {dotted name: list of values}
+    :output : folder of the runs and of the results table
+    :script : scene script run with --headless
+
+    Every name of the grid is checked before any run, an unknown one raises a KeyError
+    """
+    def __init__(self, parameters, grid, output, script):
+        self.parameters = parameters
+        self.grid = grid
+        self.output = output
+        self.script = script
+        for name in grid:
+            get_parameter(parameters, name)
+        self.variants = self.get_variants()
+
+
+    def get_variants(self):
+        """
+        Every combination of the grid values, as {dotted name: value} dictionnaries
+        """
+        names = list(self.grid)
+        return [dict(zip(names, values)) for values in itertools.product(*[self.grid[name] for name in names])]
+
+
+    def get_bundle(self, variant):
+        """
+        Vessel bundle of a variant, named after the hash of its geometry parameters
+        """
+        parameters = set_parameters(copy.deepcopy(self.parameters), variant)
+        geometry = {name: get_parameter(parameters, name) for name in GEOMETRY_PARAMETERS}
+        key = hashlib.sha256(json.dumps(geometry, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.output, "bundles", "vessels_bundle_" + key + ".npz")
+
+
+    def prepare(self):
+        """
+        Builds the vessel bundle of each distinct geometry once, before the runs, so that
+        concurrent runs only read them
+        """
+        from BaseDigitalTwin import BaseDigitalTwin
+
+        done = set()
+        for variant in self.variants:
+            bundle = self.get_bundle(variant)
+            if bundle in done:
+                continue
+            done.add(bundle)
+
+            parameters = set_parameters(copy.deepcopy(self.parameters), variant)
+            parameters['vessels']['bundle'] = bundle
+            BaseDigitalTwin().getVesselModel(parameters['vessels'])
+
+        return sorted(done)
+
+
+    def run_variant(self, index, variant, steps, timeout=None):
+        """
+        Runs one variant in a headless process, returns its row of the results table
+        """
+        directory = os.path.join(self.output, "run" + str(index))
+        os.makedirs(directory, exist_ok=True)
+
+        # Parameters of the run: the variant, its shared bundle and its own reports. 
+        # Memory tracing slows the build down, it is off unless the grid sets profiling.memory
+        overrides = dict(variant)
+        overrides['vessels.bundle'] = self.get_bundle(variant)
+        overrides['profiling.report'] = os.path.join(directory, "scene_build.json")
+        overrides['profiling.summary'] = False
+        overrides.setdefault('profiling.memory', False)
+        parameters_file = os.path.join(directory, "parameters.json")
+        with open(parameters_file, 'w') as file:
+            json.dump(overrides, file, indent=4)
+        report = os.path.join(directory, "simulation.json")
+
+        command = [sys.executable, self.script, '--headless', '--steps', str(steps), '--report', report,
+                   '--parameters', parameters_file, '--no-centerlines']
+        start = time.perf_counter()
+        with open(os.path.join(directory, "log.txt"), 'w') as log:
+            try:
+                returncode = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(self.script)),
+                                            stdout=log, stderr=subprocess.STDOUT, timeout=timeout).returncode
+            except subprocess.TimeoutExpired:
+                returncode = 'timeout'
+        wall_time = time.perf_counter() - start
+
+        row = {'run': index}
+        row.update(variant)
+        row.update({'returncode': returncode, 'wall_time': wall_time})
+
+        # Metrics of the run, missing when it failed
+        if os.path.exists(report):
+            with open(report) as file:
+                simulation = json.load(file)
+            row.update({'build_time': simulation['build_time'], 'simulation_time': simulation['wall_time'],
+                        'steps_per_second': simulation['steps_per_second'], 'mean_step_time': simulation['mean_step_time'],
+                        'dofs': simulation['dofs']['total'], 'independent_dofs': simulation['dofs']['independent']})
+        else:
+            print("Error: run ", index, " failed, see ", os.path.join(directory, "log.txt"))
+
+        return row
+
+
+    def run(self, steps, workers=1, timeout=None):
+        """
+        Runs all the variants, workers at a time, returns the results table in variant order
+        """
+        self.prepare()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(self.run_variant, range(len(self.variants)), self.variants,
+                                 itertools.repeat(steps), itertools.repeat(timeout)))
+        return rows
+
+
+    def save(self, rows):
+        """
+        Writes the results table as csv and json in the output folder
+        """
+        columns = []
+        for row in rows:
+            columns.extend(name for name in row if name not in columns)
+
+        with open(os.path.join(self.output, "results.csv"), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(os.path.join(self.output, "results.json"), 'w') as file:
+            json.dump(rows, file, indent=4)
+
+
+
+if __name__ == '__main__':
+    root = os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir)
+    sys.path.append(os.path.abspath(root))
+    from parameters import digitaltwin
+
+    parser = argparse.ArgumentParser(description="Parameter sweep of the liver digital twin")
+    parser.add_argument('grid', help="json file of {dotted parameter name: list of values}")
+    parser.add_argument('--steps', type=int, default=100, help="time steps of each run")
+    parser.add_argument('--workers', type=int, default=1, help="runs at the same time")
+    parser.add_argument('--timeout', type=float, default=None, help="seconds before a run is stopped")
+    parser.add_argument('--output', default="./data/sweep", help="folder of the runs and of the results table")
+    arguments = parser.parse_args()
+
+    with open(arguments.grid) as file:
+        grid = json.load(file)
+    output = os.path.abspath(arguments.output)
+    os.makedirs(output, exist_ok=True)
+
+    # Paths of the parameters are relative to the repository
+    os.chdir(root)
+
+    # The grid is checked before anything runs
+    sweep = ParameterSweep(digitaltwin, grid, output, os.path.join(root, "DigitalTwin.py"))
+
+    # The skeleton is computed once here, the runs only read it
+    if 'vessels.meshFile' in grid or 'vessels.skeleton_output' in grid:
+        print("Error: the vessel mesh and skeleton can not be swept, the runs share one skeleton")
+        sys.exit(1)
+    from BaseDigitalTwin import BaseDigitalTwin
+    BaseDigitalTwin().get_centerlines(digitaltwin['vessels']['meshFile'], digitaltwin['vessels']['skeleton_output'])
+
+    print(len(sweep.variants), " variants, ", arguments.workers, " workers")
+    rows = sweep.run(arguments.steps, arguments.workers, arguments.timeout)
+    sweep.save(rows)
+
+    for row in rows:
+        print(", ".join(str(name) + " " + str(value) for name, value in row.items()))
+    print("Results written in ", os.path.join(output, "results.csv"))
@@ -1,9 +1,98 @@
+import hashlib
+import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
 from beam import Beam
+from bezier import BezierBatch
+
+
+# Version of the preprocessing: sampling, Bezier frames, quaternions, bifurcation table and tree assembly. 
+# To be bumped with any change of their outputs, vessel bundles of another version are rebuilt
+PREPROCESSING_VERSION = 4
+
+# Default distance under which two branch extremities are the same bifurcation, 
+# the adjacency_tolerance of the vessels parameters
+ADJACENCY_TOLERANCE = 1e-6
+
+
+def preprocess_beams(beam_class, branches, sampling_rate, sampling_mode, frame_mode, adaptive=None): 
+    """
+    Samples a chunk of branches and fits the Bezier frames of all of them at once, 
+    run by the preprocessing workers
+
+    Returns the beams, with their frames and topology computed
+    """
+    beams = [beam_class(branch, sampling_rate, sampling_mode, frame_mode, adaptive) for branch in branches]
+    tangentes, normals, binormals = BezierBatch.from_branches([beam.sample for beam in beams], frame_mode).get_frames()
+    for i, beam in enumerate(beams): 
+        beam.frames = (tangentes[i], normals[i], binormals[i])
+        beam.get_topology()
+    return beams
+
+
+def get_misalignment(rigid, edges): 
+    """
+    Angle in degrees between each element and the x axis of its end nodes, the largest of the two. 
+    BeamFEMForceField assumes that an element lies along the local x axis of its nodes
+
+    :rigid : positions + quaternions (x, y, z, w) of the nodes, shape (M, 7)
+    :edges : elements in node indices, shape (E, 2)
+
+    Returns the angles, shape (E,)
+    """
+    rigid = np.asarray(rigid, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    x, y, z, w = rigid[:, 3:].T
+    axis = np.stack([1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y)], axis=1)
+
+    direction = rigid[edges[:, 1], :3] - rigid[edges[:, 0], :3]
+    direction = direction/np.linalg.norm(direction, axis=1)[:, None]
+    cosines = np.minimum(np.sum(axis[edges[:, 0]] * direction, axis=1), np.sum(axis[edges[:, 1]] * direction, axis=1))
+    return np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
 
 class VGraph: 
-    def __init__(self, vaisseau, sampling_rate):
+    def __init__(self, vaisseau, sampling_rate, beam_class=Beam, sampling_mode="arclength", tolerance=ADJACENCY_TOLERANCE, frame_mode="rmf", adaptive=None, 
+                 workers=1, executor="process", chunk_size=64):
         self.sampling_rate = sampling_rate
-        self.vaisseau = vaisseau 
+        self.sampling_mode = sampling_mode
+        self.frame_mode = frame_mode
+
+        # Settings of the "adaptive" sampling mode, see Beam.get_adaptive_sample
+        self.adaptive = adaptive
+
+        # Spatial hash of the branch extremities: {cell: [(branch index, extremity index), ...]}, 
+        # two extremities closer than the tolerance are considered as the same bifurcation
+        self.tolerance = tolerance
+        self.endpoints = {}
+
+        # Beam registry: {(branch index, sampling rate): beam}, shared by graph building, 
+        # modeling, coupling and mapping so that each branch is sampled once
+        self.beam_class = beam_class
+        self.beams = {}
+
+        # Bifurcation tables: {sampling rate: table}, see get_bifurcations
+        self.bifurcations = {}
+
+        # Streamed branches whose points were released, with the digest and the length of their points
+        self.streamed = set()
+        self.digests = {}
+        self.lengths = {}
+
+        # Branches, a removed branch is left as None so that the other indices do not move. 
+        # A list or a tuple is kept as it is. Any other iterable, e.g. a streaming skeleton reader, 
+        # is streamed: each branch is sampled as it is read, by the workers when there are several, 
+        # and its points are released, so the memory grows with the beams and the chunks in flight, see stream_branches
+        self.vaisseau = []
+        if isinstance(vaisseau, (list, tuple)): 
+            self.vaisseau = list(vaisseau)
+            self.get_endpoints_index()
+        else: 
+            self.stream_branches(vaisseau, workers, executor, chunk_size)
+
         self.graph = self.get_graph()
      
     def get_graph(self):
@@ -27,35 +116,690 @@ class VGraph:
         graph = {}
         number_of_branch = len(self.vaisseau)
         for i in range(number_of_branch): 
+            if self.vaisseau[i] is None: 
+                continue
             adjacent_branchs = self.get_adjacent_branchs(i)
             graph[str(i)] = adjacent_branchs
 
         return graph
         
+
+    def stream_branches(self, branches, workers=1, executor="process", chunk_size=64):
+        """
+        Adds the branches read from a stream, their extremities are added to the spatial hash as they are read. 
+        With one worker each branch is sampled at the graph sampling rate as it is read, otherwise the branches 
+        are sent to the workers by chunks, see preprocess_beams, at most two chunks per worker in flight. 
+        The points of a branch are released once its beam is back, see release_branch
+
+        :workers : number of workers, 1 runs in the calling thread, None uses all the cores
+        :executor : "process" for a ProcessPoolExecutor, "thread" for a ThreadPoolExecutor
+        :chunk_size : number of branches sent to a worker at once
+        """
+        if workers == 1: 
+            for branch in branches: 
+                index = self.append_branch(branch)
+                self.release_branch(index, self.beam_class(branch, self.sampling_rate, self.sampling_mode, self.frame_mode, self.adaptive))
+            return
+
+        if executor == "thread": 
+            pool = ThreadPoolExecutor(max_workers=workers)
+        else: 
+            pool = ProcessPoolExecutor(max_workers=workers)
+        in_flight = 2 * (workers or os.cpu_count() or 1)
+
+        # (branch indices, future of their beams) in reading order
+        pending = deque()
+        def submit(chunk): 
+            pending.append((chunk, pool.submit(preprocess_beams, self.beam_class, [self.vaisseau[index] for index in chunk], 
+                                               self.sampling_rate, self.sampling_mode, self.frame_mode, self.adaptive)))
+            while len(pending) >= in_flight: 
+                self.release_chunk(*pending.popleft())
+
+        with pool: 
+            chunk = []
+            for branch in branches: 
+                chunk.append(self.append_branch(branch))
+                if len(chunk) == chunk_size: 
+                    submit(chunk)
+                    chunk = []
+            if len(chunk): 
+                submit(chunk)
+            while len(pending): 
+                self.release_chunk(*pending.popleft())
+    
+
+    def append_branch(self, branch): 
+        """
+        Adds a branch at the end of the vessel and its extremities to the spatial hash, returns its index
+        """
+        index = len(self.vaisseau)
+        self.vaisseau.append(branch)
+        self.add_endpoints(index)
+        return index
+    
+
+    def release_chunk(self, chunk, future): 
+        """
+        Waits for the beams of a chunk of streamed branches and releases their points
+        """
+        for index, beam in zip(chunk, future.result()): 
+            self.release_branch(index, beam)
+    
+
+    def release_branch(self, index, beam): 
+        """
+        Puts the beam of a streamed branch in the registry and releases the points of the branch, unless they 
+        are a memory mapped view of a binary skeleton: the branch is replaced by the beam sample, which has 
+        the same extremities, and only the digest and the length of the points are kept for the adjacency 
+        and the sampling report. A released branch can not be sampled again at another rate or mode
+        """
+        branch = self.vaisseau[index]
+        self.beams[(index, self.sampling_rate)] = beam
+        self.digests[index] = self.get_digest(branch)
+
+        if not isinstance(branch, np.memmap): 
+            self.lengths[index] = self.get_length(branch)
+            beam.branche = np.asarray(beam.sample, dtype=np.float64).reshape(-1, 3)
+            self.vaisseau[index] = beam.branche
+            self.streamed.add(index)
+    
+
+    def get_length(self, branch):
+        """
+        Length of the polyline through the points of a branch
+        """
+        return np.sum(np.linalg.norm(np.diff(np.asarray(branch, dtype=np.float64).reshape(-1, 3), axis=0), axis=1))
+    
+
+    def get_digest(self, branch):
+        """
+        Hash of the points of a branch, two branches with the same points have the same digest
+        """
+        return hashlib.sha1(np.ascontiguousarray(branch, dtype=np.float64).reshape(-1, 3).tobytes()).hexdigest()
+    
+
+    def get_branch_digest(self, index):
+        """
+        Digest of the points of a branch, kept for the streamed branches and computed for the others
+        """
+        if index in self.digests: 
+            return self.digests[index]
+        return self.get_digest(self.vaisseau[index])
+    
+
+    def is_same_branch(self, index, other):
+        """
+        Tests if two branches have the same points, through their digests when one of them was streamed
+        """
+        if index in self.digests or other in self.digests: 
+            return self.get_branch_digest(index) == self.get_branch_digest(other)
+        return self.equal(self.vaisseau[index], self.vaisseau[other])
+    
+
+    def get_cell(self, point):
+        """
+        Gets the cell of the spatial hash holding a point, cells are cubes of the tolerance size
+        """
+        cell_size = max(self.tolerance, np.finfo(np.float64).tiny)
+        return tuple(np.floor(np.asarray(point, dtype=np.float64) / cell_size).astype(np.int64).tolist())
+    
+
+    def get_endpoints_index(self):
+        """
+        Builds the spatial hash of the extremities of all the branches
+        """
+        self.endpoints = {}
+        for index in range(len(self.vaisseau)): 
+            if self.vaisseau[index] is not None: 
+                self.add_endpoints(index)
+
+        return self.endpoints
+    
+
+    def add_endpoints(self, index):
+        """
+        Adds the extremities of a branch to the spatial hash
+        """
+        branch = self.vaisseau[index]
+        for extremity, point in enumerate([branch[0], branch[-1]]): 
+            self.endpoints.setdefault(self.get_cell(point), []).append((index, extremity))
+    
+
+    def remove_endpoints(self, index):
+        """
+        Removes the extremities of a branch from the spatial hash
+        """
+        branch = self.vaisseau[index]
+        for extremity, point in enumerate([branch[0], branch[-1]]): 
+            cell = self.get_cell(point)
+            self.endpoints[cell].remove((index, extremity))
+            if not self.endpoints[cell]: 
+                del self.endpoints[cell]
+    
+
+    def get_neighbors(self, point):
+        """
+        Gets the (branch index, extremity index) of the extremities closer than the tolerance to a point
+        """
+        cell = self.get_cell(point)
+        neighbors = []
+        for dx in (-1, 0, 1): 
+            for dy in (-1, 0, 1): 
+                for dz in (-1, 0, 1): 
+                    for index, extremity in self.endpoints.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), []): 
+                        other = self.vaisseau[index][0] if extremity == 0 else self.vaisseau[index][-1]
+                        if np.linalg.norm(np.subtract(point, other)) <= self.tolerance: 
+                            neighbors.append((index, extremity))
+
+        return neighbors
+    
     
     def get_adjacent_branchs(self, index):
         """
-        List of adjacent branchs of a branch
+        List of adjacent branchs of a branch: branches having an extremity 
+        at one of its extremities, found through the spatial hash
 
         :index : index of the input branch
         """
-        beam = Beam(self.vaisseau[index], self.sampling_rate)
+        branch = self.vaisseau[index]
 
-        vertices = beam.get_vertices()
+        vertices = [branch[0], branch[-1]]
         adjacent_branchs = []
         for i in range(len(vertices)): 
-            at_this_vertice = []
-            for j in range(len(self.vaisseau)): 
-                if vertices[i] in self.vaisseau[j] and not self.equal(self.vaisseau[index], self.vaisseau[j]):
-                    at_this_vertice.append(j)
-            adjacent_branchs.append(at_this_vertice)
+            at_this_vertice = set()
+            for j, _ in self.get_neighbors(vertices[i]): 
+                if j != index and not self.is_same_branch(index, j):
+                    at_this_vertice.add(j)
+            adjacent_branchs.append(sorted(at_this_vertice))
         return adjacent_branchs
     
 
+    def get_adjacents(self, index):
+        """
+        Set of the branches adjacent to a branch at any of its extremities
+        """
+        adjacents = self.graph.get(str(index), [[], []])
+        return set(adjacents[0]) | set(adjacents[1])
+    
+
+    def update(self, index, branch):
+        """
+        Puts a branch (None to remove it) at an index and recomputes only the 
+        adjacency of the branches connected to it, before or after the update
+
+        Returns the sorted list of the branch indices whose adjacency or beams changed
+        """
+        changed = {index} | self.get_adjacents(index)
+
+        if index < len(self.vaisseau) and self.vaisseau[index] is not None: 
+            self.remove_endpoints(index)
+        if index == len(self.vaisseau): 
+            self.vaisseau.append(branch)
+        else: 
+            self.vaisseau[index] = branch
+        self.invalidate([index])
+
+        # The new branch keeps its points
+        self.streamed.discard(index)
+        self.digests.pop(index, None)
+        self.lengths.pop(index, None)
+
+        if branch is None: 
+            self.graph.pop(str(index), None)
+        else: 
+            self.add_endpoints(index)
+            self.graph[str(index)] = self.get_adjacent_branchs(index)
+            changed |= self.get_adjacents(index)
+
+        for j in changed: 
+            if j != index and self.vaisseau[j] is not None: 
+                self.graph[str(j)] = self.get_adjacent_branchs(j)
+
+        return sorted(changed)
+    
+
+    def add_branch(self, branch):
+        """
+        Adds a branch at the end of the vessel, its index is len(vaisseau) before the call
+
+        Returns the sorted list of the changed branch indices
+        """
+        return self.update(len(self.vaisseau), branch)
+    
+
+    def remove_branch(self, index):
+        """
+        Removes a branch, the indices of the other branches are kept
+
+        Returns the sorted list of the changed branch indices
+        """
+        return self.update(index, None)
+    
+
+    def replace_branch(self, index, branch):
+        """
+        Replaces a branch, e.g. after a segmentation fix
+
+        Returns the sorted list of the changed branch indices
+        """
+        return self.update(index, branch)
+    
+
+    def get_ragged(self, branches=None):
+        """
+        Gets all the branches as a ragged array
+
+            points = concatenated points of all the branches, shape (P, 3)
+
+            offsets = start of each branch in points followed by P, shape (N + 1,)
+
+        :branches : optional list of branches, the vessel branches in graph order by default, 
+                    the samples for the streamed branches whose points were released
+        """
+        if branches is None: 
+            branches = [self.vaisseau[int(key)] for key in self.graph]
+        batch = BezierBatch.from_branches(branches)
+        return batch.points, batch.offsets
+    
+
+    def get_beam(self, index, sampling_rate=None):
+        """
+        Gets the beam of a branch from the registry, the branch is sampled 
+        the first time it is requested
+
+        :index : index of the branch
+        :sampling_rate : sampling rate of the beam, the graph one by default
+        """
+        if sampling_rate is None: 
+            sampling_rate = self.sampling_rate
+
+        key = (index, sampling_rate)
+        if key not in self.beams and index in self.streamed: 
+            print("Error: the points of the streamed branch ", index, " were released, it can not be sampled at ", sampling_rate)
+            return None
+        if key not in self.beams: 
+            self.beams[key] = self.beam_class(self.vaisseau[index], sampling_rate, self.sampling_mode, self.frame_mode, self.adaptive)
+
+        return self.beams[key]
+    
+
+    def set_sampling_rate(self, sampling_rate):
+        """
+        Changes the sampling rate of the graph, beams sampled at the previous rate are dropped
+        """
+        if sampling_rate != self.sampling_rate: 
+            if len(self.streamed): 
+                print("Error: the points of the streamed branches were released, the sampling rate can not change")
+                return
+            self.invalidate()
+            self.sampling_rate = sampling_rate
+    
+
+    def set_sampling_mode(self, sampling_mode):
+        """
+        Changes the sampling mode of the graph ("arclength", "adaptive" or "legacy"), sampled beams are dropped
+        """
+        if sampling_mode != self.sampling_mode: 
+            if len(self.streamed): 
+                print("Error: the points of the streamed branches were released, the sampling mode can not change")
+                return
+            self.invalidate()
+            self.sampling_mode = sampling_mode
+    
+
+    def invalidate(self, indices=None):
+        """
+        Drops beams from the registry, they will be sampled again on the next request, 
+        and the bifurcation tables that used them
+
+        :indices : branches to drop, all of them by default
+        """
+        self.bifurcations = {}
+        if indices is None: 
+            self.beams = {}
+        else: 
+            indices = set(indices)
+            self.beams = {key: beam for key, beam in self.beams.items() if key[0] not in indices}
+    
+
+    def get_frames(self, sampling_rate=None):
+        """
+        Fits the Bezier curves of all the beams that have no frames yet at once, 
+        and returns the (tangentes, normals, binormals) of every beam in graph order
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        beams = [self.get_beam(int(key), sampling_rate) for key in self.graph]
+
+        todo = [beam for beam in beams if beam.frames is None]
+        if len(todo): 
+            points, offsets = self.get_ragged([beam.sample for beam in todo])
+            tangentes, normals, binormals = BezierBatch(points, offsets, self.frame_mode).get_frames()
+            for i, beam in enumerate(todo): 
+                beam.frames = (tangentes[i], normals[i], binormals[i])
+
+        return [beam.frames for beam in beams]
+    
+
+    def get_fixed_indices(self, index, sampling_rate=None):
+        """
+        Gets the node indices of the free extremities of a beam, the ones without adjacent 
+        branches, they will be fixed by the boundary condition
+
+        :index : index of the branch
+        :sampling_rate : sampling rate of the beam, the graph one by default
+        """
+        adjacents = self.graph[str(index)]
+        beam = self.get_beam(index, sampling_rate)
+
+        fixed_indices = []
+        if len(adjacents[0]) == 0: 
+            fixed_indices.append(0)
+        if len(adjacents[1]) == 0: 
+            fixed_indices.append(beam.num_nodes - 1)
+
+        return fixed_indices
+    
+
+    def get_bifurcations(self, sampling_rate=None): 
+        """
+        Gets the node indices coupled at each bifurcation, the table is computed once per 
+        sampling rate and kept on the graph until a beam is invalidated
+
+            bifurcations = {(source branch, source extremity, target branch): (source node, target node)}
+
+        The target node is the target beam node nearest to the source extremity, it has to be 
+        closer than the tolerance. Bifurcations are at the beam extremities, so the extremities 
+        of all the pairs are matched at once, and the whole sample is searched only if both are too far
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        if sampling_rate is None: 
+            sampling_rate = self.sampling_rate
+        if sampling_rate in self.bifurcations: 
+            return self.bifurcations[sampling_rate]
+
+        # Extremities of every beam, shape (2, 3)
+        beams = {int(key): self.get_beam(int(key), sampling_rate) for key in self.graph}
+        ends = {index: np.asarray([beam.sample[0], beam.sample[-1]], dtype=np.float64) for index, beam in beams.items()}
+
+        # One row per (source branch, source extremity, target branch)
+        rows = [(int(key), extremity, target) for key, adjacents in self.graph.items() for extremity in range(2) for target in adjacents[extremity]]
+        if not len(rows): 
+            self.bifurcations[sampling_rate] = {}
+            return {}
+        points = np.stack([ends[index][extremity] for index, extremity, _ in rows])
+        targets = np.stack([ends[target] for _, _, target in rows])
+
+        # Nearest target extremity of all the rows at once
+        distance = np.linalg.norm(targets - points[:, None, :], axis=2)
+        nearest = np.argmin(distance, axis=1)
+        nearest_distance = distance[np.arange(len(rows)), nearest]
+
+        bifurcations = {}
+        for row, (index, extremity, target) in enumerate(rows): 
+            source_node = extremity * (beams[index].num_nodes - 1)
+            target_node = int(nearest[row]) * (beams[target].num_nodes - 1)
+
+            # The bifurcation is not at a target extremity: nearest node of the whole sample
+            if nearest_distance[row] > self.tolerance: 
+                target_node, gap = self.get_nearest_node(beams[target], points[row])
+                if gap > self.tolerance: 
+                    print("Error: Bifurcation of the beams ", index, " and ", target, " not found")
+                    continue
+            bifurcations[(index, extremity, target)] = (source_node, target_node)
+
+        self.bifurcations[sampling_rate] = bifurcations
+        return bifurcations
+    
+
+    def get_nearest_node(self, beam, point): 
+        """
+        Gets the (index, distance) of the beam node nearest to a point
+        """
+        distance = np.linalg.norm(np.asarray(beam.sample, dtype=np.float64) - point, axis=1)
+        nearest = int(np.argmin(distance))
+        return nearest, distance[nearest]
+    
+
+    def preprocess(self, sampling_rate=None, workers=1, executor="process"): 
+        """
+        Samples and fits all the beams not in the registry yet. With one worker the beams are 
+        sampled then fitted at once with get_frames, otherwise the branches are split in chunks 
+        and each worker fits its chunk at once, see preprocess_beams. 
+        The beams are put in the registry in graph order, whatever the number of workers. 
+        The branches of a streamed graph were already sampled while reading, see stream_branches, 
+        only the frames of the ones sampled in the calling thread are left
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        :workers : number of workers, 1 runs in the calling thread, None uses all the cores
+        :executor : "process" for a ProcessPoolExecutor, "thread" for a ThreadPoolExecutor
+        """
+        if sampling_rate is None: 
+            sampling_rate = self.sampling_rate
+
+        # Streamed branches are already sampled at the graph rate, they can not be sampled again
+        indices = [int(key) for key in self.graph if (int(key), sampling_rate) not in self.beams and int(key) not in self.streamed]
+
+        if workers == 1 or len(indices) < 2: 
+            for index in indices: 
+                self.get_beam(index, sampling_rate).get_topology()
+            self.get_frames(sampling_rate)
+            return [self.get_beam(int(key), sampling_rate) for key in self.graph]
+
+        if executor == "thread": 
+            pool = ThreadPoolExecutor(max_workers=workers)
+        else: 
+            pool = ProcessPoolExecutor(max_workers=workers)
+
+        # Branches are sent by chunks, a few chunks per worker to balance long and short branches
+        number_of_chunks = min(len(indices), 4 * (workers or os.cpu_count() or 1))
+        chunks = [chunk.tolist() for chunk in np.array_split(indices, number_of_chunks)]
+        with pool: 
+            results = pool.map(preprocess_beams, repeat(self.beam_class), [[self.vaisseau[index] for index in chunk] for chunk in chunks], 
+                               repeat(sampling_rate), repeat(self.sampling_mode), repeat(self.frame_mode), repeat(self.adaptive))
+            for chunk, beams in zip(chunks, results): 
+                for index, beam in zip(chunk, beams): 
+                    self.beams[(index, sampling_rate)] = beam
+
+        # Frames of the beams sampled before, e.g. the streamed ones
+        self.get_frames(sampling_rate)
+
+        return [self.get_beam(int(key), sampling_rate) for key in self.graph]
+    
+
+    def get_sampling_report(self, sampling_rate=None): 
+        """
+        Compares the number of beam nodes with a uniform arc length sampling at the sampling rate. 
+        Each node is a Rigid3d node, 6 dofs, and one spring to the parenchyma
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        if sampling_rate is None: 
+            sampling_rate = self.sampling_rate
+
+        nodes = 0
+        uniform_nodes = 0
+        for key in self.graph: 
+            beam = self.get_beam(int(key), sampling_rate)
+            length = self.lengths[int(key)] if int(key) in self.lengths else self.get_length(beam.branche)
+            nodes += beam.num_nodes
+            uniform_nodes += max(1, int(round(length / sampling_rate))) + 1 if length > 0 else 1
+
+        return {
+            'mode': self.sampling_mode, 
+            'nodes': nodes, 
+            'uniform_nodes': uniform_nodes, 
+            'dofs': 6 * nodes, 
+            'uniform_dofs': 6 * uniform_nodes, 
+            'reduction': 1 - nodes / uniform_nodes if uniform_nodes else 0, 
+        }
+    
+
+    def get_orientations(self, sampling_rate=None): 
+        """
+        Orients every branch away from a root, so that at a bifurcation the parent branch ends 
+        where its children start. The root of each connected part of the graph is chosen among its 
+        branches with a free extremity, as the one giving the smallest sum of the angles between 
+        each parent and its children at the bifurcations, see get_junction_cost. It starts at its 
+        free extremity and the branches are visited breadth first from it
+
+        Returns the branch indices in visiting order and, for each of them, its entry extremity: 
+        0 when the branch already runs away from the root, 1 when it has to be reversed
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        frames = dict(zip([int(key) for key in self.graph], self.get_frames(sampling_rate)))
+
+        order = []
+        entries = {}
+        for key in self.graph: 
+            if int(key) in entries: 
+                continue
+
+            # Any first root, then the cost change of rooting the part at each other branch: the parents 
+            # only change at the bifurcations on the way from the first root, see get_junction_cost
+            part_order, part_entries, parents = self.visit(int(key))
+            change = {part_order[0]: 0}
+            for index in part_order[1:]: 
+                parent, extremity = parents[index]
+                change[index] = np.inf
+                if parent in change and extremity != part_entries[parent]: 
+                    change[index] = change[parent] + self.get_junction_cost(index, part_entries[index], frames) \
+                                                   - self.get_junction_cost(parent, extremity, frames)
+
+            candidates = [index for index in part_order if len(self.graph[str(index)][0]) == 0 or len(self.graph[str(index)][1]) == 0]
+            if len(candidates): 
+                root = min(candidates, key=lambda index: (change[index], int(index)))
+                part_order, part_entries, _ = self.visit(root)
+
+            order.extend(part_order)
+            entries.update(part_entries)
+
+        return order, entries
+    
+
+    def visit(self, root): 
+        """
+        Visits the branches connected to a root breadth first, the root starts at its free extremity if it has one
+
+        Returns the visiting order, the entry extremity of each branch, and the (branch, extremity) it was reached from
+        """
+        entries = {root: 0 if len(self.graph[str(root)][0]) == 0 or len(self.graph[str(root)][1]) != 0 else 1}
+        parents = {}
+        order = []
+        queue = deque([root])
+        while len(queue): 
+            index = queue.popleft()
+            order.append(index)
+            for extremity in [1 - entries[index], entries[index]]: 
+                for adjacent in self.graph[str(index)][extremity]: 
+                    if adjacent not in entries: 
+                        # The child enters by its extremity touching the parent
+                        entries[adjacent] = 0 if index in self.graph[str(adjacent)][0] else 1
+                        parents[adjacent] = (index, extremity)
+                        queue.append(adjacent)
+        return order, entries, parents
+    
+
+    def get_junction_cost(self, index, extremity, frames): 
+        """
+        Sum of the angles in degrees between a branch arriving at one of its extremities and 
+        the other branches leaving from there, when this branch is their parent
+
+        :frames : {branch index: (tangentes, normals, binormals)}
+        """
+        def leaving(branch, end): 
+            tangente = np.asarray(frames[branch][0][0] if end == 0 else -np.asarray(frames[branch][0][-1]), dtype=np.float64)
+            return tangente/np.linalg.norm(tangente)
+
+        arriving = -leaving(index, extremity)
+        cost = 0
+        for adjacent in self.graph[str(index)][extremity]: 
+            end = 0 if index in self.graph[str(adjacent)][0] else 1
+            cost += np.degrees(np.arccos(np.clip(np.dot(arriving, leaving(adjacent, end)), -1, 1)))
+        return cost
+    
+
+    def get_tree(self, sampling_rate=None):
+        """
+        Assembles all the beams into a single tree, the nodes shared by branches at 
+        a bifurcation are merged into one node
+
+            rigid = positions + quaternions of all the tree nodes, shape (M, 7)
+
+            edges = edges of all the beams in tree node indices, shape (E, 2)
+
+            nodes = for each branch in graph order, the tree index of each of its nodes
+
+            fixed = tree indices of the free extremities, the ones without adjacent branches
+
+        The branches are oriented away from a root and placed in that order, see get_orientations: 
+        a reversed branch gets its nodes in reverse order, its tangentes and binormals flipped, and its 
+        edges run from its entry extremity. A node shared at a bifurcation keeps the position and 
+        the quaternion of the parent branch, whose x axis is its tangente at its end: the element of 
+        a child branch at the bifurcation is off this axis by the branching angle, see get_misalignment
+
+        :sampling_rate : sampling rate of the beams, the graph one by default
+        """
+        frames = dict(zip([int(key) for key in self.graph], self.get_frames(sampling_rate)))
+        order, entries = self.get_orientations(sampling_rate)
+
+        rigid = []
+        edges = []
+        nodes = {}
+        fixed = []
+
+        # Tree index of the extremities already placed: {(branch index, extremity index): tree index}
+        placed = {}
+        number_of_nodes = 0
+        for index in order: 
+            adjacents = self.graph[str(index)]
+            beam = self.get_beam(index, sampling_rate)
+            topology = beam.get_topology()
+
+            # Nodes, frames and edges running away from the root
+            local_order = np.arange(beam.num_nodes)
+            if entries[index] == 0: 
+                MO = beam.get_MO_rigid(frames[index])
+            else: 
+                local_order = local_order[::-1]
+                tangentes, normals, binormals = [np.asarray(frame, dtype=np.float64)[::-1] for frame in frames[index]]
+                quaternions = beam.get_quaternions(-tangentes, normals, -binormals)
+                MO = np.hstack([np.asarray(beam.get_MO_vec(), dtype=np.float64)[::-1], quaternions])
+                topology = topology[:, ::-1]
+
+            # New tree indices for all the nodes, then the extremities already in the tree are reused
+            tree_index = np.zeros(beam.num_nodes, dtype=np.int64)
+            keep = np.ones(beam.num_nodes, dtype=bool)
+            free = []
+            for extremity, local in enumerate([0, beam.num_nodes - 1]): 
+                shared = [placed[neighbor] for neighbor in self.get_neighbors(beam.vertices[extremity]) if neighbor in placed]
+                if len(shared): 
+                    tree_index[local] = shared[0]
+                    keep[local] = False
+                elif len(adjacents[extremity]) == 0: 
+                    free.append(local)
+
+            # Consecutive tree indices for the new nodes, in the oriented order
+            new = local_order[keep[local_order]]
+            tree_index[new] = number_of_nodes + np.arange(len(new))
+            fixed.extend(tree_index[free].tolist())
+            for extremity, local in enumerate([0, beam.num_nodes - 1]): 
+                placed.setdefault((index, extremity), tree_index[local])
+
+            rigid.append(MO[keep[local_order]])
+            edges.append(tree_index[topology])
+            nodes[index] = tree_index
+            number_of_nodes += len(new)
+
+        return np.concatenate(rigid), np.concatenate(edges), [nodes[int(key)] for key in self.graph], sorted(set(fixed))
+    
+
     def equal(self, list1, list2): 
         """
         Testing if two lists are equal, 
         
         this function should be mooved to a Helper
         """
-        return list1 == list2
\ No newline at end of file
+        return np.array_equal(list1, list2)
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Shared fixture of the checks run without Sofa: the centerlines of the repository, read only,
+the skeletonization is not run, and the report of the failures. Importing it puts src in the path
+"""
+import sys, os
+
+dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir, 'src')
+sys.path.append(os.path.abspath(dir))
+
+from BaseDigitalTwin import BaseDigitalTwin
+
+# Input text file of the centerlines
+SKELETON_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir, "data", "skeleton", "output_skeleton.txt")
+
+# Sampling rate of the vessels in the parameters
+SAMPLING_RATE = 0.005
+
+
+def read_branches(filename=SKELETON_FILE):
+    """
+    Reads all the branches of a skeleton, the centerlines of the repository by default
+    """
+    return BaseDigitalTwin().getSkeletonData(filename)
+
+
+def stream_branches(filename=SKELETON_FILE):
+    """
+    Reads the branches of a skeleton one at a time, the centerlines of the repository by default
+    """
+    return BaseDigitalTwin().iterSkeletonData(filename)
+
+
+class CheckReport:
+    """
+    Counts and prints the failures of a check script, exit gives its exit code: 1 on a failure
+    """
+    def __init__(self):
+        self.failures = 0
+
+    def error(self, *context):
+        """
+        Prints a failure, the context is printed as print does
+        """
+        self.failures += 1
+        print("Error: ", *context)
+
+    def compare(self, name, worst, tolerance):
+        """
+        Prints a largest difference against its tolerance, it fails above the tolerance
+        """
+        status = "ok" if worst <= tolerance else "FAILED"
+        self.failures += status != "ok"
+        print("{:<32} max difference {:.3g} (tolerance {:.3g}) {}".format(name, worst, tolerance, status))
+
+    def exit(self, *summary):
+        """
+        Prints the summary followed by the number of failures and exits
+        """
+        print(*summary, ", ", self.failures, " failures")
+        sys.exit(1 if self.failures else 0)
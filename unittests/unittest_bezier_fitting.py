@@ -10,6 +10,7 @@ print(dir)
 
 from BaseDigitalTwin import BaseDigitalTwin
 from beam import Beam
+from bezier import Bezier
 
 if __name__ == '__main__':
     """
@@ -49,8 +50,11 @@ if __name__ == '__main__':
         sample.c(color)
         SampledPoints.append(sample)
 
+        # Dense evaluation of the fitted Bezier curve, all the segments at once
+        list_x, list_y, list_z = Bezier(beam.sample).evaluate_bezier(50)
+
         # Vedo Bezier Curves visualization 
-        BezierCurves.append(vedo.Bezier(beam.sample).c(color))
+        BezierCurves.append(vedo.Line(np.stack([list_x, list_y, list_z], axis=1)).c(color))
 
     # Plotting
     vedo.show(SampledPoints, BezierCurves)
\ No newline at end of file
@@ -0,0 +1,134 @@
+import numpy as np
+
+from checks import SAMPLING_RATE, CheckReport, read_branches
+from beam import Beam
+from bezier import Bezier, BezierBatch
+
+# pyquaternion is only used as a reference for the vectorized quaternions
+try:
+    from pyquaternion import Quaternion
+except ImportError:
+    Quaternion = None
+
+
+def dense_bezier_coef(points):
+    """
+    Control points of the original implementation: the full matrix is built and solved with np.linalg.solve. 
+    A single segment is the straight cubic, whose control points are at the thirds of the segment: the original 
+    implementation overwrote its first row with the last one, and its tangentes were not along the segment
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points) - 1
+    if n == 1:
+        return (2 * points[:1] + points[1:]) / 3, (points[:1] + 2 * points[1:]) / 3
+
+    C = 4 * np.identity(n)
+    np.fill_diagonal(C[1:], 1)
+    np.fill_diagonal(C[:, 1:], 1)
+    C[0, 0] = 2
+    C[n - 1, n - 1] = 7
+    C[n - 1, n - 2] = 2
+
+    P = 4 * points[:-1] + 2 * points[1:]
+    P[0] = points[0] + 2 * points[1]
+    P[n - 1] = 8 * points[n - 1] + points[n]
+
+    A = np.linalg.solve(C, P)
+    B = np.zeros((n, 3))
+    B[:-1] = 2 * points[1:-1] - A[1:]
+    B[n - 1] = (A[n - 1] + points[n]) / 2
+
+    return A, B
+
+
+def dense_tangentes(points, A, B):
+    """
+    Tangentes of the original implementation: derivate at t=0 of each segment and at t=1 of the last one
+    """
+    points = np.asarray(points, dtype=np.float64)
+    tangentes = np.vstack([3 * (A - points[:-1]), 3 * (points[-1] - B[-1])])
+    return tangentes / np.linalg.norm(tangentes, axis=1)[:, None]
+
+
+def check_thomas_solver(curves):
+    """
+    Largest difference between the Thomas solver and the dense solve, on the control points and on the tangentes
+    """
+    worst = 0
+    for points in curves:
+        bezier = Bezier(points)
+        A, B = bezier.get_bezier_coef()
+        A_dense, B_dense = dense_bezier_coef(points)
+        tangentes = np.asarray(bezier.get_tangentes())
+        worst = max(worst, np.abs(A - A_dense).max(), np.abs(B - B_dense).max(),
+                    np.abs(tangentes - dense_tangentes(points, A_dense, B_dense)).max())
+    return worst
+
+
+def check_batch(curves):
+    """
+    Largest difference between the batched fit of all the curves and the fit of each curve on its own
+    """
+    batch = BezierBatch.from_branches(curves)
+    A_batch, B_batch = batch.get_bezier_coef()
+    A_batch, B_batch = np.split(A_batch, batch.segment_offsets[1:-1]), np.split(B_batch, batch.segment_offsets[1:-1])
+    tangentes, normals, binormals = batch.get_frames()
+
+    worst = 0
+    for i, points in enumerate(curves):
+        bezier = Bezier(points)
+        A, B = bezier.get_bezier_coef()
+        single = bezier.get_tangentes()
+        single_normals = bezier.get_normals(single)
+        single_binormals = bezier.get_binormals(single, single_normals)
+        worst = max(worst, np.abs(A_batch[i] - A).max(), np.abs(B_batch[i] - B).max(),
+                    np.abs(tangentes[i] - np.asarray(single)).max(), np.abs(normals[i] - np.asarray(single_normals)).max(),
+                    np.abs(binormals[i] - np.asarray(single_binormals)).max())
+    return worst
+
+
+def check_quaternions(curves):
+    """
+    Largest difference between the vectorized quaternions and pyquaternion, q and -q being the same rotation
+    """
+    beam = Beam(curves[0], 1)
+    worst = 0
+    for points in curves:
+        tangentes, normals, binormals = BezierBatch.from_branches([points]).get_frames()
+        quaternions = beam.get_quaternions(tangentes[0], normals[0], binormals[0])
+        for quaternion, t, n, b in zip(quaternions, tangentes[0], normals[0], binormals[0]):
+            reference = Quaternion(matrix=np.stack([t, n, b], axis=1), atol=1e-9)
+            reference = np.array([reference.x, reference.y, reference.z, reference.w])
+            worst = max(worst, min(np.abs(quaternion - reference).max(), np.abs(quaternion + reference).max()))
+    return worst
+
+
+if __name__ == '__main__':
+    """
+        Checks the Bezier solvers without Sofa on the centerlines of the repository:
+            -> Thomas solver against the dense solve of the original implementation
+            -> batched fit of all the branches against the fit of each branch
+            -> vectorized quaternions against pyquaternion
+    """
+
+    vessel = read_branches()
+
+    # Raw branches, their samples and 2 and 3 points curves, the smallest systems
+    curves = [np.asarray(branch, dtype=np.float64) for branch in vessel]
+    curves += [np.asarray(Beam(branch, SAMPLING_RATE).sample, dtype=np.float64) for branch in vessel]
+    curves += [curve[:2] for curve in curves[:10]] + [curve[:3] for curve in curves[:10]]
+    curves = [curve for curve in curves if len(curve) >= 2]
+    print(len(curves), " curves, ", sum(len(curve) == 2 for curve in curves), " of 2 points")
+
+    checks = [("Thomas solver vs dense solve", check_thomas_solver, 1e-10),
+              ("batched fit vs single fit", check_batch, 0)]
+    if Quaternion is None:
+        print("pyquaternion is not installed, the quaternions are not checked")
+    else:
+        checks.append(("quaternions vs pyquaternion", check_quaternions, 1e-12))
+
+    report = CheckReport()
+    for name, check, tolerance in checks:
+        report.compare(name, check(curves), tolerance)
+
+    report.exit(len(checks), " checks")
@@ -11,6 +11,12 @@ from BaseDigitalTwin import BaseDigitalTwin
 from beam import Beam
 from bezier import Bezier
 
+# pyquaternion is only used as a reference for the vectorized quaternions
+try:
+    from pyquaternion import Quaternion
+except ImportError:
+    Quaternion = None
+
 if __name__ == '__main__':
     """
         Given sampled points from the centerlines, this plots quaternions at each point, 
@@ -50,6 +56,15 @@ if __name__ == '__main__':
         normals = Bezier(sample).get_normals(tangentes)
         binomials = Bezier(sample).get_binormals(tangentes, normals)
 
+        # Checking the vectorized quaternions (x, y, z, w) against pyquaternion, q and -q being the same rotation
+        if Quaternion is not None:
+            quaternions = beam.get_quaternions(tangentes, normals, binomials)
+            for i in range(len(sample)):
+                reference = Quaternion(matrix=np.array([tangentes[i], normals[i], binomials[i]]).T, atol=1e-6)
+                reference = np.array([reference[1], reference[2], reference[3], reference[0]])
+                if not (np.allclose(quaternions[i], reference) or np.allclose(quaternions[i], -reference)):
+                    print("Error: quaternion mismatch at point ", i, quaternions[i], reference)
+
         # Plotting the vectors 
         for i in range(len(sample)):
 
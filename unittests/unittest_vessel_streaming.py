@@ -0,0 +1,70 @@
+import os
+import tempfile
+import numpy as np
+
+from checks import SAMPLING_RATE, SKELETON_FILE, CheckReport, read_branches, stream_branches
+import vessel as vessel_module
+from skeleton import convert_skeleton
+from vessel import VGraph
+
+
+def check_streaming(reference, skeleton_file, workers):
+    """
+    Builds a VGraph from the streamed skeleton with the thread executor, then compares its graph,
+    samples, frames and bifurcation table with the ones of a VGraph built from a list
+
+    Returns the list of the errors and the number of branches sampled by preprocess_beams
+    """
+    calls = []
+    preprocess_beams = vessel_module.preprocess_beams
+    def counted(beam_class, branches, *arguments):
+        calls.append(len(branches))
+        return preprocess_beams(beam_class, branches, *arguments)
+
+    vessel_module.preprocess_beams = counted
+    try:
+        streamed = VGraph(stream_branches(skeleton_file), SAMPLING_RATE, workers=workers, executor="thread", chunk_size=8)
+        streamed.preprocess(SAMPLING_RATE, workers=workers, executor="thread")
+    finally:
+        vessel_module.preprocess_beams = preprocess_beams
+
+    errors = []
+    if streamed.graph != reference.graph:
+        errors.append("graph differs from the list graph")
+    for key in reference.graph:
+        beam, expected = streamed.get_beam(int(key)), reference.get_beam(int(key))
+        if not np.array_equal(np.asarray(beam.sample), np.asarray(expected.sample)):
+            errors.append("sample of the branch " + key + " differs")
+        elif not np.allclose(np.asarray(beam.frames), np.asarray(expected.frames)):
+            errors.append("frames of the branch " + key + " differ")
+    if streamed.get_bifurcations() != reference.get_bifurcations():
+        errors.append("bifurcation table differs")
+
+    # With several workers, every branch is sampled by the workers
+    if workers != 1 and sum(calls) != len(reference.graph):
+        errors.append(str(sum(calls)) + " of " + str(len(reference.graph)) + " branches went through preprocess_beams")
+
+    return errors, sum(calls)
+
+
+if __name__ == '__main__':
+    """
+        Checks the streamed VGraph without Sofa, on the centerlines of the repository, read as text
+        and as a binary skeleton: with one or several workers it must give the same graph, beams and
+        bifurcations as a VGraph built from a list, and several workers must sample every branch
+    """
+
+    reference = VGraph(read_branches(), SAMPLING_RATE)
+    reference.preprocess(SAMPLING_RATE)
+
+    report = CheckReport()
+    with tempfile.TemporaryDirectory() as directory:
+        binary_file = convert_skeleton(SKELETON_FILE, os.path.join(directory, "output_skeleton.npy"))
+        for filename in [SKELETON_FILE, binary_file]:
+            for workers in [1, 4]:
+                errors, sampled = check_streaming(reference, filename, workers)
+                for error in errors:
+                    report.error(os.path.basename(filename), ", ", workers, " workers: ", error)
+                print(os.path.basename(filename), ", ", workers, " workers: ", sampled, " branches sampled by preprocess_beams")
+
+    report.exit(len(reference.graph), " branches")
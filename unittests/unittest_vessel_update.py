@@ -0,0 +1,64 @@
+import numpy as np
+
+from checks import SAMPLING_RATE, CheckReport, read_branches
+from vessel import VGraph
+
+
+def check_update(vessel, index, branch):
+    """
+    Updates a branch of the graph, then compares the graph with a graph built from scratch
+    on the same branches, the sample of the updated beam and the returned changed indices
+
+    Returns the list of the errors
+    """
+    before = dict(vessel.graph)
+    if branch is None:
+        changed = vessel.remove_branch(index)
+    elif index == len(vessel.vaisseau):
+        changed = vessel.add_branch(branch)
+    else:
+        changed = vessel.replace_branch(index, branch)
+
+    errors = []
+    rebuilt = VGraph(list(vessel.vaisseau), vessel.sampling_rate, tolerance=vessel.tolerance)
+    if vessel.graph != rebuilt.graph:
+        errors.append("graph differs from a full rebuild")
+
+    # Every branch whose adjacency changed, and the updated one, are reported
+    moved = {int(key) for key in set(before) | set(vessel.graph) if before.get(key) != vessel.graph.get(key)}
+    if not (moved | {index}) <= set(changed):
+        errors.append("changed indices " + str(changed) + " miss " + str(sorted((moved | {index}) - set(changed))))
+
+    # The beam of the updated branch is sampled again
+    if branch is not None and not np.array_equal(vessel.get_beam(index).sample, rebuilt.get_beam(index).sample):
+        errors.append("stale beam")
+
+    return errors
+
+
+if __name__ == '__main__':
+    """
+        Checks the incremental updates of VGraph without Sofa, on the centerlines of the repository:
+        removing, adding back, adding and replacing a branch by a moved one must give the same graph
+        as a VGraph built from scratch
+    """
+
+    branches = read_branches()
+
+    report = CheckReport()
+    for index in range(len(branches)):
+        vessel = VGraph(list(branches), SAMPLING_RATE)
+        for beam_index in range(len(branches)):
+            vessel.get_beam(beam_index)
+        moved = (np.asarray(branches[index]) + 0.01).tolist()
+
+        steps = [("remove", index, None),
+                 ("add back", len(branches), branches[index]),
+                 ("replace by a moved branch", len(branches), moved),
+                 ("replace back", len(branches), branches[index]),
+                 ("add a duplicate", len(branches) + 1, branches[index])]
+        for name, position, branch in steps:
+            for error in check_update(vessel, position, branch):
+                report.error("branch ", index, ", ", name, ": ", error)
+
+    report.exit(len(branches), " branches")